@@ -56,6 +56,14 @@
     let imgH = 0;
     let originalImgSrc = "";
 
+    // Run analyses as background jobs and wait for them over SSE/polling, so no
+    // request stays open for the whole analysis (proxy idle timeouts).
+    // Jobs live in the server worker that accepted them, so only enable this
+    // with a single worker or sticky routing. false streams progress back on
+    // the POST /analyze?stream=true response itself.
+    const USE_ANALYSIS_JOBS = false;
+    const JOB_POLL_MS = 1000;
+
     function fileToDataUrl(file) {
         return new Promise(function (resolve) {
             var reader = new FileReader();
@@ -193,33 +201,167 @@
         formData.append("image", selectedFile, selectedFile.name || "image.jpg");
 
         try {
-            const res = await fetch("/analyze", { method: "POST", body: formData });
+            const url = "/analyze?regions=packed" + (USE_ANALYSIS_JOBS ? "&job=true" : "&stream=true");
+            const res = await fetch(url, { method: "POST", body: formData });
+            const streamed = (res.headers.get("content-type") || "").startsWith("text/event-stream");
             let data;
-            try { data = await res.json(); } catch (_) { data = {}; }
-
-            if (!res.ok) {
-                let msg = "Analysis failed";
-                if (data.detail) {
-                    if (typeof data.detail === "string") msg = data.detail;
-                    else if (Array.isArray(data.detail) && data.detail.length)
-                        msg = data.detail.map((d) => d.msg || JSON.stringify(d)).join("; ");
-                    else msg = JSON.stringify(data.detail);
-                }
-                throw new Error(msg);
+            if (res.ok && streamed) {
+                data = await readAnalysisStream(res, showStage, renderEarlyMetrics);
+            } else {
+                try { data = await res.json(); } catch (_) { data = {}; }
+                if (!res.ok) throw new Error(detailMessage(data.detail));
+                if (res.status === 202 && data.job_id) data = await waitForJob(data, showStage, renderEarlyMetrics);
             }
 
+            data.regions = unpackRegions(data);
             renderResults(data);
         } catch (err) {
+            resultsDiv.style.display = "none";
             showError(err instanceof Error ? err.message : String(err));
         } finally {
             loading.style.display = "none";
+            loadingText.textContent = defaultLoadingText;
             analyzeBtn.disabled = false;
         }
     };
 
+    function detailMessage(detail) {
+        if (!detail) return "Analysis failed";
+        if (typeof detail === "string") return detail;
+        if (Array.isArray(detail) && detail.length)
+            return detail.map((d) => d.msg || JSON.stringify(d)).join("; ");
+        return JSON.stringify(detail);
+    }
+
+    // Wait for a background analysis job: server-sent events where available,
+    // polling /jobs/{id} otherwise (or if the event stream can't be opened).
+    // onStage(name) follows pipeline progress; onMetrics(data) gets the metrics
+    // before the annotated image is ready. Polling reports neither.
+    function waitForJob(job, onStage, onMetrics) {
+        return new Promise(function (resolve, reject) {
+            if (!window.EventSource) {
+                pollJob(job.status_url).then(resolve, reject);
+                return;
+            }
+            const events = new EventSource(job.events_url);
+            events.addEventListener("stage", function (e) {
+                if (onStage) onStage(JSON.parse(e.data).stage);
+            });
+            events.addEventListener("metrics", function (e) {
+                if (onMetrics) onMetrics(JSON.parse(e.data));
+            });
+            events.addEventListener("result", function (e) {
+                events.close();
+                resolve(JSON.parse(e.data));
+            });
+            events.addEventListener("failed", function (e) {
+                events.close();
+                reject(new Error(detailMessage(JSON.parse(e.data).detail)));
+            });
+            events.onerror = function () {
+                // EventSource reconnects by itself unless the stream is gone for good.
+                if (events.readyState === EventSource.CLOSED) pollJob(job.status_url).then(resolve, reject);
+            };
+        });
+    }
+
+    // Read the server-sent events of POST /analyze?stream=true from the response
+    // body as they arrive: "stage" and "metrics" frames report progress, then
+    // a "result" or "failed" frame ends the analysis.
+    async function readAnalysisStream(res, onStage, onMetrics) {
+        let outcome = null;
+        function handleFrame(frame) {
+            let event = "message";
+            const dataLines = [];
+            frame.split("\n").forEach(function (line) {
+                if (line.startsWith("event:")) event = line.slice(6).trim();
+                else if (line.startsWith("data:")) dataLines.push(line.slice(5).replace(/^ /, ""));
+            });
+            if (!dataLines.length) return;  // keep-alive comment
+            const data = JSON.parse(dataLines.join("\n"));
+            if (event === "stage" && onStage) onStage(data.stage);
+            else if (event === "metrics" && onMetrics) onMetrics(data);
+            else if (event === "result") outcome = { result: data };
+            else if (event === "failed") outcome = { error: data };
+        }
+
+        if (res.body && res.body.getReader) {
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+            while (!outcome) {
+                const chunk = await reader.read();
+                if (chunk.done) break;
+                buffer += decoder.decode(chunk.value, { stream: true }).replace(/\r\n?/g, "\n");
+                let end;
+                while (!outcome && (end = buffer.indexOf("\n\n")) !== -1) {
+                    handleFrame(buffer.slice(0, end));
+                    buffer = buffer.slice(end + 2);
+                }
+            }
+            reader.cancel().catch(function () {});
+        } else {
+            (await res.text()).replace(/\r\n?/g, "\n").split("\n\n").forEach(function (frame) {
+                if (!outcome) handleFrame(frame);
+            });
+        }
+
+        if (!outcome) throw new Error("Connection lost before the analysis finished");
+        if (outcome.error) throw new Error(detailMessage(outcome.error.detail));
+        return outcome.result;
+    }
+
+    async function pollJob(statusUrl) {
+        for (;;) {
+            const res = await fetch(statusUrl);
+            const data = await res.json().catch(() => ({}));
+            if (!res.ok) throw new Error(detailMessage(data.detail));
+            if (data.status === "done") return data.result;
+            if (data.status === "failed") throw new Error(detailMessage(data.error && data.error.detail));
+            await new Promise((r) => setTimeout(r, JOB_POLL_MS));
+        }
+    }
+
+    const STAGE_MESSAGES = {
+        received: "Image received. Waiting for the analyzer...",
+        upstream_sent: "Analyzing your skin...",
+        upstream_parsed: "Results in. Drawing the annotated image...",
+        rendered: "Saving your analysis...",
+        persisted: "Almost done..."
+    };
+    const loadingText = loading.querySelector("span");
+    const defaultLoadingText = loadingText.textContent;
+
+    function showStage(stage) {
+        if (STAGE_MESSAGES[stage]) loadingText.textContent = STAGE_MESSAGES[stage];
+    }
+
+    // Metrics arrive before the annotated image: show the dials right away.
+    function renderEarlyMetrics(data) {
+        resultImg.removeAttribute("src");
+        metricsDiv.innerHTML = "";
+        renderDials(data.metrics || {});
+        resultsDiv.style.display = "block";
+    }
+
+    function renderDials(metrics) {
+        var dialsContainer = document.getElementById("analysis-dials");
+        if (!dialsContainer) return;
+        dialsContainer.innerHTML = "";
+        var dialItems = extractDialMetrics(metrics);
+        if (dialItems.length > 0) {
+            var dHtml = '<div class="dial-grid">';
+            dialItems.forEach(function (d) {
+                dHtml += buildSingleDial(d.label, d.value, d.key, d.direction);
+            });
+            dHtml += "</div>";
+            dialsContainer.innerHTML = dHtml;
+        }
+    }
+
     // ── Render Results ──
     function renderResults(data) {
-        resultImg.src = data.image_base64 || "";
+        resultImg.src = data.image_url || data.image_base64 || "";
         resultImg.alt = "Annotated analysis result";
 
         regionsData = data.regions || {};
@@ -278,19 +420,7 @@
 
         rawPre.textContent = JSON.stringify(data, null, 2).slice(0, 8000);
 
-        var dialsContainer = document.getElementById("analysis-dials");
-        if (dialsContainer) {
-            dialsContainer.innerHTML = "";
-            var dialItems = extractDialMetrics(data.metrics || {});
-            if (dialItems.length > 0) {
-                var dHtml = '<div class="dial-grid">';
-                dialItems.forEach(function (d) {
-                    dHtml += buildSingleDial(d.label, d.value, d.key, d.direction);
-                });
-                dHtml += "</div>";
-                dialsContainer.innerHTML = dHtml;
-            }
-        }
+        renderDials(data.metrics || {});
 
         buildConditionTabs(data);
 
@@ -622,6 +752,26 @@
           color: { fill: "rgba(74,144,217,0.2)", stroke: "#4a90d9" } }
     ];
 
+    // Expand compact regions (?regions=packed|columns) back to {left, top, width, height} lists
+    function unpackRegions(data) {
+        var regions = data.regions || {};
+        var format = data.regions_format || "objects";
+        if (format === "objects") return regions;
+        var out = {};
+        Object.keys(regions).forEach(function (key) {
+            var v = regions[key], rects = [], i;
+            if (format === "packed") {
+                for (i = 0; i + 3 < v.length; i += 4)
+                    rects.push({ left: v[i], top: v[i + 1], width: v[i + 2], height: v[i + 3] });
+            } else {
+                for (i = 0; i < v.left.length; i++)
+                    rects.push({ left: v.left[i], top: v.top[i], width: v.width[i], height: v.height[i] });
+            }
+            out[key] = rects;
+        });
+        return out;
+    }
+
     function getNestedVal(obj, path) {
         var parts = path.split(".");
         var v = obj;
@@ -647,7 +797,7 @@
         });
         tabBar.innerHTML = tabHtml;
 
-        var origImg = originalImgSrc || data.image_base64 || "";
+        var origImg = originalImgSrc || data.image_url || data.image_base64 || "";
         var regions = data.regions || {};
         var iw = data.image_width || 0;
         var ih = data.image_height || 0;
@@ -779,8 +929,8 @@
         var aIh = (aFull && aFull.image_height) || 0;
         var bId = compData.before.id;
         var aId = compData.after.id;
-        var bThumb = "/history/" + encodeURIComponent(bId) + "/thumb";
-        var aThumb = "/history/" + encodeURIComponent(aId) + "/thumb";
+        var bThumb = "/history/" + encodeURIComponent(bId) + "/image";
+        var aThumb = "/history/" + encodeURIComponent(aId) + "/image";
 
         var tabHtml = '<button class="condition-tab active" data-cpanel="comp-panel-overview">Overview</button>';
         var activeTabs = [];
@@ -975,6 +1125,8 @@
     const beforeList = document.getElementById("before-list");
     const afterList = document.getElementById("after-list");
     const btnCompare = document.getElementById("btn-compare");
+    const btnHistoryMore = document.getElementById("btn-history-more");
+    const HISTORY_PAGE_SIZE = 50;
     const compareLoading = document.getElementById("compare-loading");
     const compareError = document.getElementById("compare-error");
     const compareResults = document.getElementById("compare-results");
@@ -983,6 +1135,48 @@
 
     let selectedBefore = null;
     let selectedAfter = null;
+    let historyCursor = null;
+
+    async function fetchHistoryPage(cursor) {
+        let url = "/history?limit=" + HISTORY_PAGE_SIZE;
+        if (cursor) url += "&cursor=" + encodeURIComponent(cursor);
+        const res = await fetch(url);
+        if (!res.ok) throw new Error("Failed to load history");
+        return res.json();
+    }
+
+    function appendHistoryEntries(entries) {
+        entries.forEach((entry) => {
+            const card = buildHistoryCard(entry);
+            const cardClone = buildHistoryCard(entry);
+
+            card.onclick = () => selectCard(beforeList, card, entry.id, "before");
+            cardClone.onclick = () => selectCard(afterList, cardClone, entry.id, "after");
+
+            beforeList.appendChild(card);
+            afterList.appendChild(cardClone);
+        });
+    }
+
+    function updateHistoryMore(nextCursor) {
+        historyCursor = nextCursor || null;
+        btnHistoryMore.style.display = historyCursor ? "block" : "none";
+    }
+
+    btnHistoryMore.onclick = async () => {
+        if (!historyCursor) return;
+        btnHistoryMore.disabled = true;
+        try {
+            const page = await fetchHistoryPage(historyCursor);
+            appendHistoryEntries(page.entries);
+            updateHistoryMore(page.next_cursor);
+        } catch (err) {
+            compareError.textContent = "Error loading history: " + (err instanceof Error ? err.message : String(err));
+            compareError.style.display = "block";
+        } finally {
+            btnHistoryMore.disabled = false;
+        }
+    };
 
     async function loadHistory() {
         historyLoading.style.display = "flex";
@@ -993,11 +1187,11 @@
         selectedBefore = null;
         selectedAfter = null;
         btnCompare.disabled = true;
+        updateHistoryMore(null);
 
         try {
-            const res = await fetch("/history");
-            if (!res.ok) throw new Error("Failed to load history");
-            const entries = await res.json();
+            const page = await fetchHistoryPage(null);
+            const entries = page.entries;
 
             if (entries.length < 2) {
                 noHistory.style.display = "block";
@@ -1010,17 +1204,8 @@
 
             beforeList.innerHTML = "";
             afterList.innerHTML = "";
-
-            entries.forEach((entry) => {
-                const card = buildHistoryCard(entry);
-                const cardClone = buildHistoryCard(entry);
-
-                card.onclick = () => selectCard(beforeList, card, entry.id, "before");
-                cardClone.onclick = () => selectCard(afterList, cardClone, entry.id, "after");
-
-                beforeList.appendChild(card);
-                afterList.appendChild(cardClone);
-            });
+            appendHistoryEntries(entries);
+            updateHistoryMore(page.next_cursor);
 
             historyGrid.style.display = "grid";
         } catch (err) {
@@ -1070,8 +1255,8 @@
         try {
             const [compRes, bDataRes, aDataRes] = await Promise.all([
                 fetch("/compare/" + encodeURIComponent(selectedBefore) + "/" + encodeURIComponent(selectedAfter)),
-                fetch("/history/" + encodeURIComponent(selectedBefore) + "/data"),
-                fetch("/history/" + encodeURIComponent(selectedAfter) + "/data")
+                fetch("/history/" + encodeURIComponent(selectedBefore) + "/data?regions=packed"),
+                fetch("/history/" + encodeURIComponent(selectedAfter) + "/data?regions=packed")
             ]);
             if (!compRes.ok) {
                 const d = await compRes.json().catch(() => ({}));
@@ -1080,6 +1265,8 @@
             const data = await compRes.json();
             const bFullData = bDataRes.ok ? await bDataRes.json() : null;
             const aFullData = aDataRes.ok ? await aDataRes.json() : null;
+            if (bFullData) bFullData.regions = unpackRegions(bFullData);
+            if (aFullData) aFullData.regions = unpackRegions(aFullData);
             renderComparison(data, bFullData, aFullData);
         } catch (err) {
             compareError.textContent = err instanceof Error ? err.message : String(err);
@@ -11,114 +11,403 @@ except ImportError:
     pass
 import io
 import base64
-import requests
-from PIL import Image, ImageDraw, ImageFont
+import asyncio
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from PIL import Image, ImageDraw, ImageFont, ImageOps, UnidentifiedImageError, features
+
+from cache import ResponseCache, content_key, file_key
+from regions import extract_regions
+from resilience import TokenBucket, CircuitBreaker, backoff_delay
+
+logger = logging.getLogger(__name__)
 
 SKIN_ANALYSIS_PRO_URL = "https://www.ailabapi.com/api/portrait/analysis/skin-analysis-pro"
 
+# Shared upstream connection pool. Keep-alive connections are reused across
+# requests, so TLS handshakes and DNS lookups only happen for new connections.
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "50"))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "60"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "10"))
 
-def _get_jpeg_bytes(image_bytes: bytes) -> bytes:
-    """Convert image bytes to JPEG (API only accepts JPEG/JPG)."""
-    img = Image.open(io.BytesIO(image_bytes))
-    if img.mode in ("RGBA", "P"):
-        img = img.convert("RGB")
-    jpeg_buffer = io.BytesIO()
-    img.save(jpeg_buffer, format="JPEG", quality=95)
-    jpeg_buffer.seek(0)
-    return jpeg_buffer.read()
+# Calls are paced to the plan's QPS (0 = unlimited); a call that would wait
+# longer than UPSTREAM_MAX_QUEUE_WAIT for a token is refused instead.
+UPSTREAM_QPS = float(os.environ.get("UPSTREAM_QPS", "0"))
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", str(max(1.0, UPSTREAM_QPS))))
+UPSTREAM_MAX_QUEUE_WAIT = float(os.environ.get("UPSTREAM_MAX_QUEUE_WAIT", "10"))
 
+# Transient failures (network errors, timeouts, 429 and 5xx) are retried with
+# jittered exponential backoff. After UPSTREAM_BREAKER_FAILURES consecutive
+# failures the breaker opens and calls fail fast for UPSTREAM_BREAKER_RESET s.
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.environ.get("UPSTREAM_BACKOFF_MAX", "8"))
+UPSTREAM_BREAKER_FAILURES = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", "5"))
+UPSTREAM_BREAKER_RESET = float(os.environ.get("UPSTREAM_BREAKER_RESET", "30"))
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
 
-def analyze_skin(image_bytes: bytes, api_key: str) -> dict:
-    """
-    Call AILab Skin Analysis Pro API.
-    Returns raw API response dict.
-    """
-    jpeg_data = _get_jpeg_bytes(image_bytes)
-    files = {"image": ("image.jpg", jpeg_data, "image/jpeg")}
-    headers = {"ailabapi-api-key": api_key}
-    response = requests.post(SKIN_ANALYSIS_PRO_URL, data={}, files=files, headers=headers)
-    return response.json()
+upstream_limiter = TokenBucket(UPSTREAM_QPS, UPSTREAM_BURST)
+upstream_breaker = CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_RESET)
+_upstream_counters = {"calls": 0, "retries": 0, "timeouts": 0, "failures": 0}
 
+_client = None
 
-def create_annotated_image(api_response: dict, image_bytes: bytes) -> bytes:
-    """
-    Create composite image with skin annotations and full JSON metrics panel.
-    Returns PNG bytes.
-    """
-    if api_response.get("error_code", 0) != 0:
-        raise ValueError(api_response.get("error_msg", "API error"))
+# Bounded pool for the CPU-bound stages (JPEG conversion, drawing, encoding).
+# At most CPU_WORKERS jobs run and CPU_QUEUE_SIZE wait; beyond that callers
+# get WorkerPoolFull so the API can shed load instead of stalling.
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(os.cpu_count() or 2)))
+CPU_QUEUE_SIZE = int(os.environ.get("CPU_QUEUE_SIZE", str(CPU_WORKERS * 4)))
+CPU_RETRY_AFTER = int(os.environ.get("CPU_RETRY_AFTER", "2"))
 
-    r = api_response.get("result", {})
-    face_rect = api_response.get("face_rectangle", {})
+_cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="analysis-cpu")
+_cpu_slots = threading.BoundedSemaphore(CPU_WORKERS + CPU_QUEUE_SIZE)
 
-    vis_img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    draw = ImageDraw.Draw(vis_img)
-    w, h = vis_img.size
 
+class WorkerPoolFull(Exception):
+    """Raised when every CPU worker is busy and the wait queue is full."""
+
+    def __init__(self, retry_after: int = CPU_RETRY_AFTER):
+        super().__init__("Server busy, please retry shortly")
+        self.retry_after = retry_after
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when the AILab API is rate limited, failing, or its breaker is open."""
+
+    def __init__(self, message: str, retry_after: float = 1):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class InvalidImage(Exception):
+    """Raised when an upload cannot be decoded as an image."""
+
+    def __init__(self):
+        super().__init__("File is not a valid image")
+
+
+# Cache of upstream responses keyed on the JPEG bytes that would be sent.
+CACHE_DIR = Path(os.environ.get("ANALYSIS_CACHE_DIR", str(Path(__file__).resolve().parent / "cache")))
+CACHE_MEMORY_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_MEMORY_ENTRIES", "256"))
+CACHE_DISK_MB = int(os.environ.get("ANALYSIS_CACHE_DISK_MB", "512"))
+CACHE_TTL = float(os.environ.get("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+
+response_cache = ResponseCache(
+    CACHE_DIR,
+    max_entries=CACHE_MEMORY_ENTRIES,
+    max_disk_bytes=CACHE_DISK_MB * 1024 * 1024,
+    ttl=CACHE_TTL,
+)
+
+
+async def run_cpu(fn, *args):
+    """Run fn(*args) on the CPU pool, or raise WorkerPoolFull if saturated."""
+    if not _cpu_slots.acquire(blocking=False):
+        raise WorkerPoolFull()
     try:
-        font = ImageFont.truetype("arial.ttf", min(24, w // 40))
-        font_sm = ImageFont.truetype("arial.ttf", min(18, w // 55))
+        future = _cpu_pool.submit(fn, *args)
     except Exception:
-        font = ImageFont.load_default()
-        font_sm = font
+        _cpu_slots.release()
+        raise
+    # Release on completion of the job itself, not of the awaiting request,
+    # so a disconnected client cannot free a slot its work is still using.
+    future.add_done_callback(lambda _: _cpu_slots.release())
+    return await asyncio.wrap_future(future)
+
+
+async def open_upstream_client() -> httpx.AsyncClient:
+    """Create the shared AILab client (called from the app lifespan)."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+        )
+    return _client
+
+
+async def close_upstream_client():
+    """Close the shared AILab client and its pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+EXIF_ORIENTATION = 0x0112
+
+# Longest side (px) of the image sent upstream; 0 sends full resolution.
+# Rectangles in the response are scaled back to the original image.
+UPSTREAM_MAX_DIMENSION = int(os.environ.get("UPSTREAM_MAX_DIMENSION", "0"))
+
+
+def _get_jpeg_bytes(img: Image.Image) -> bytes:
+    """Encode a decoded image as JPEG (API only accepts JPEG/JPG)."""
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    jpeg_buffer = io.BytesIO()
+    img.save(jpeg_buffer, format="JPEG", quality=95)
+    return jpeg_buffer.getvalue()
 
-    COLORS = {
-        "face": (0, 255, 255),
-        "dark_circle": (128, 0, 128),
-        "brown_spot": (139, 90, 43),
-        "comedone": (255, 255, 0),
-        "acne_mark": (255, 0, 0),
-    }
 
-    def draw_rect(rect_dict, color, label=None, width=3):
-        if not rect_dict:
-            return
-        x1 = rect_dict.get("left", 0)
-        y1 = rect_dict.get("top", 0)
-        x2 = x1 + rect_dict.get("width", 0)
-        y2 = y1 + rect_dict.get("height", 0)
-        for i in range(width):
-            draw.rectangle([x1 - i, y1 - i, x2 + i, y2 + i], outline=color)
-        if label:
-            draw.text((x1, y1 - 22), label, fill=color, font=font_sm)
+def _is_passthrough_jpeg(img: Image.Image) -> bool:
+    """True when the upload can be sent upstream byte-for-byte."""
+    # Only upright RGB JPEGs: a rotated EXIF orientation could make the API
+    # report coordinates for a different pixel layout than the one we draw on.
+    return (
+        img.format == "JPEG"
+        and img.mode == "RGB"
+        and img.getexif().get(EXIF_ORIENTATION, 1) == 1
+    )
 
-    # 1. Face rectangle
-    if face_rect:
-        draw_rect(face_rect, COLORS["face"], "Face", width=4)
 
-    # 2. Dark circle / eye pouch regions
-    dcm = r.get("dark_circle_mark", {})
-    if dcm:
-        draw_rect(dcm.get("left_eye_rect"), COLORS["dark_circle"], "Dark circle (L)", width=2)
-        draw_rect(dcm.get("right_eye_rect"), COLORS["dark_circle"], "Dark circle (R)", width=2)
+def _prepare_upload(source, digest: str = None) -> tuple:
+    """
+    Decode an upload once and normalize it for the API.
+    source is the upload as bytes or a Path to it on disk; digest is its
+    content_key if already known (e.g. hashed while streaming it in).
+    Returns (rgb_image, jpeg_data, cache_key, (scale_x, scale_y)). Acceptable
+    JPEGs are passed through unchanged (jpeg_data is then source itself, so a
+    file is streamed upstream from disk); everything else is re-encoded at
+    quality 95, after downscaling to UPSTREAM_MAX_DIMENSION if configured.
+    The scale maps upstream coordinates back to the original image.
+    """
+    img = Image.open(source if isinstance(source, Path) else io.BytesIO(source))
+    img.load()
+    scale = (1.0, 1.0)
+    w, h = img.size
+    if UPSTREAM_MAX_DIMENSION and max(w, h) > UPSTREAM_MAX_DIMENSION:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        ratio = UPSTREAM_MAX_DIMENSION / max(w, h)
+        size = (max(1, round(w * ratio)), max(1, round(h * ratio)))
+        small = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        jpeg_data = _get_jpeg_bytes(small)
+        scale = (w / size[0], h / size[1])
+    elif _is_passthrough_jpeg(img):
+        # Already RGB, and the upload's own hash is the cache key.
+        if digest is None:
+            digest = file_key(source) if isinstance(source, Path) else content_key(source)
+        return img, source, digest, scale
+    else:
+        jpeg_data = _get_jpeg_bytes(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img, jpeg_data, content_key(jpeg_data), scale
+
+
+THUMB_SIZE = int(os.environ.get("THUMB_SIZE", "320"))
+if features.check("webp"):
+    THUMB_FORMAT, THUMB_MEDIA_TYPE, THUMB_EXT = "WEBP", "image/webp", ".webp"
+else:
+    THUMB_FORMAT, THUMB_MEDIA_TYPE, THUMB_EXT = "JPEG", "image/jpeg", ".jpg"
+
+
+def create_thumbnail(src_path: Path, dest_path: Path, size: int = THUMB_SIZE):
+    """Write a small THUMB_FORMAT thumbnail of src_path, upright per EXIF."""
+    with Image.open(src_path) as img:
+        # Let the JPEG decoder downscale by DCT scaling instead of decoding full size.
+        img.draft("RGB", (size, size))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((size, size), Image.LANCZOS)
+        tmp = dest_path.with_name(f"{dest_path.name}.{threading.get_ident()}.tmp")
+        img.save(tmp, format=THUMB_FORMAT, quality=80)
+    os.replace(tmp, dest_path)
+
+
+RECT_KEYS = ("left", "top", "width", "height")
+
+
+def _rescale_rects(obj, scale_x: float, scale_y: float):
+    """Scale every {left, top, width, height} dict in an API response in place."""
+    if isinstance(obj, dict):
+        if all(isinstance(obj.get(k), (int, float)) for k in RECT_KEYS):
+            obj["left"] = round(obj["left"] * scale_x)
+            obj["top"] = round(obj["top"] * scale_y)
+            obj["width"] = round(obj["width"] * scale_x)
+            obj["height"] = round(obj["height"] * scale_y)
+        for v in obj.values():
+            if isinstance(v, (dict, list)):
+                _rescale_rects(v, scale_x, scale_y)
+    elif isinstance(obj, list):
+        for v in obj:
+            if isinstance(v, (dict, list)):
+                _rescale_rects(v, scale_x, scale_y)
+
+
+async def _post_upstream(jpeg_data, headers: dict) -> httpx.Response:
+    client = await open_upstream_client()
+    if isinstance(jpeg_data, Path):
+        with open(jpeg_data, "rb") as f:
+            files = {"image": ("image.jpg", f, "image/jpeg")}
+            return await client.post(SKIN_ANALYSIS_PRO_URL, data={}, files=files, headers=headers)
+    files = {"image": ("image.jpg", jpeg_data, "image/jpeg")}
+    return await client.post(SKIN_ANALYSIS_PRO_URL, data={}, files=files, headers=headers)
 
-    # 3. Brown spots
-    for rect in r.get("brown_spot", {}).get("rectangle", []):
-        draw_rect(rect, COLORS["brown_spot"], width=2)
 
-    # 4. Closed comedones
-    for rect in r.get("closed_comedones", {}).get("rectangle", []):
-        draw_rect(rect, COLORS["comedone"], width=2)
+def _retry_after_header(response: httpx.Response):
+    """Seconds from a numeric Retry-After header, or None."""
+    try:
+        return float(response.headers.get("retry-after", ""))
+    except ValueError:
+        return None
 
-    # 5. Acne marks
-    for rect in r.get("acne_mark", {}).get("rectangle", []):
-        draw_rect(rect, COLORS["acne_mark"], width=2)
 
-    # 6. Acne
-    for rect in r.get("acne", {}).get("rectangle", []):
-        draw_rect(rect, COLORS["acne_mark"], width=2)
+async def analyze_skin(jpeg_data, api_key: str) -> dict:
+    """
+    Call AILab Skin Analysis Pro API over the shared connection pool.
+    Expects JPEG bytes (see _get_jpeg_bytes) or a Path to a JPEG file, which is
+    streamed from disk. Returns raw API response dict.
+    Calls are rate limited, transient failures retried, and UpstreamUnavailable
+    is raised when the API cannot be reached (see the UPSTREAM_* settings).
+    """
+    headers = {"ailabapi-api-key": api_key}
+    failure = None
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        if not upstream_breaker.allow():
+            raise UpstreamUnavailable("AILab API is unavailable, please retry shortly",
+                                      upstream_breaker.retry_after())
+        if not await upstream_limiter.acquire(UPSTREAM_MAX_QUEUE_WAIT):
+            raise UpstreamUnavailable("AILab API rate limit reached, please retry shortly",
+                                      UPSTREAM_MAX_QUEUE_WAIT)
+        _upstream_counters["calls"] += 1
+        retry_after = None
+        try:
+            response = await _post_upstream(jpeg_data, headers)
+        except httpx.TransportError as e:
+            if isinstance(e, httpx.TimeoutException):
+                _upstream_counters["timeouts"] += 1
+            failure = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        else:
+            if response.status_code not in TRANSIENT_STATUSES:
+                upstream_breaker.record_success()
+                return response.json()
+            failure = f"HTTP {response.status_code}"
+            retry_after = _retry_after_header(response)
+
+        upstream_breaker.record_failure()
+        if attempt == UPSTREAM_RETRIES:
+            break
+        delay = min(UPSTREAM_BACKOFF_MAX, retry_after) if retry_after is not None \
+            else backoff_delay(attempt, UPSTREAM_BACKOFF, UPSTREAM_BACKOFF_MAX)
+        _upstream_counters["retries"] += 1
+        logger.warning("AILab call failed (%s); retry %d/%d in %.2fs",
+                       failure, attempt + 1, UPSTREAM_RETRIES, delay)
+        await asyncio.sleep(delay)
+
+    _upstream_counters["failures"] += 1
+    raise UpstreamUnavailable(f"AILab API request failed ({failure})",
+                              upstream_breaker.retry_after() or UPSTREAM_BACKOFF_MAX)
+
+
+def upstream_stats() -> dict:
+    """Limiter, breaker, retry and coalescing counters for the AILab upstream."""
+    return {
+        **_upstream_counters,
+        "limiter": upstream_limiter.stats(),
+        "breaker": upstream_breaker.stats(),
+        "coalescing": {**_coalesce_counters, "in_flight": len(_in_flight)},
+    }
 
-    # Legend
-    legend_y = h - 50
-    draw.rectangle([0, legend_y, w, h], fill=(30, 30, 30))
-    draw.text(
-        (15, legend_y + 12),
-        "Cyan: Face | Purple: Dark circles | Brown: Brown spots | Yellow: Comedones | Red: Acne",
-        fill=(255, 255, 255),
-        font=font_sm,
-    )
 
-    # Composite: image + metrics panel (all JSON on right)
+RENDER_MODES = ("face", "panel")
+
+# Encoding of the annotated image: format plus a quality and speed preset.
+# "fast" minimizes encode time, "small" minimizes payload size.
+ANNOTATED_FORMAT = os.environ.get("ANNOTATED_FORMAT", "webp").lower()
+ANNOTATED_QUALITY = int(os.environ.get("ANNOTATED_QUALITY", "85"))
+ANNOTATED_SPEED = os.environ.get("ANNOTATED_SPEED", "balanced").lower()
+
+ENCODING_PRESETS = {
+    "webp": {
+        "fast": {"method": 0},
+        "balanced": {"method": 2},
+        "small": {"method": 6},
+    },
+    "jpeg": {
+        "fast": {},
+        "balanced": {"optimize": True},
+        "small": {"optimize": True, "progressive": True},
+    },
+    "png": {
+        "fast": {"compress_level": 1},
+        "balanced": {"compress_level": 6},
+        "small": {"compress_level": 9, "optimize": True},
+    },
+}
+ENCODING_MEDIA_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+
+if ANNOTATED_FORMAT not in ENCODING_PRESETS:
+    raise ValueError(f"ANNOTATED_FORMAT must be one of {', '.join(ENCODING_PRESETS)}")
+if ANNOTATED_FORMAT == "webp" and not features.check("webp"):
+    logger.warning("Pillow was built without WebP support; encoding annotated images as JPEG")
+    ANNOTATED_FORMAT = "jpeg"
+if ANNOTATED_SPEED not in ENCODING_PRESETS[ANNOTATED_FORMAT]:
+    raise ValueError("ANNOTATED_SPEED must be one of fast, balanced, small")
+ANNOTATED_MEDIA_TYPE = ENCODING_MEDIA_TYPES[ANNOTATED_FORMAT]
+
+
+def encode_image(img: Image.Image, fmt: str = ANNOTATED_FORMAT, quality: int = ANNOTATED_QUALITY,
+                 speed: str = ANNOTATED_SPEED) -> bytes:
+    """Encode an image with one of the ENCODING_PRESETS."""
+    options = dict(ENCODING_PRESETS[fmt][speed])
+    if fmt != "png":
+        options["quality"] = quality
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt.upper(), **options)
+    return buffer.getvalue()
+
+
+ANNOTATION_FONT = "arial.ttf"
+
+
+@functools.lru_cache(maxsize=32)
+def _load_font(size: int):
+    """Load the annotation font once per size, falling back to PIL's default font."""
+    try:
+        return ImageFont.truetype(ANNOTATION_FONT, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+def draw_rects(draw: ImageDraw.ImageDraw, rects, color, width: int = 3, labels=None, font=None):
+    """
+    Draw a batch of same-colored rectangle outlines, width px thick growing outward.
+    One draw call per rectangle, pixel-identical to stacking width 1 px outlines.
+    labels, if given, are drawn above the matching rectangles.
+    """
+    grow = width - 1
+    for rect in rects:
+        if not rect:
+            continue
+        x1 = rect.get("left", 0)
+        y1 = rect.get("top", 0)
+        x2 = x1 + rect.get("width", 0)
+        y2 = y1 + rect.get("height", 0)
+        draw.rectangle([x1 - grow, y1 - grow, x2 + grow, y2 + grow], outline=color, width=width)
+    # Labels share the outline color, so drawing them after the whole batch
+    # gives the same pixels as interleaving them with their rectangles.
+    for rect, label in zip(rects, labels or ()):
+        if rect and label:
+            draw.text((rect.get("left", 0), rect.get("top", 0) - 22), label, fill=color, font=font)
+
+
+def _render_metrics_panel(vis_img: Image.Image, api_response: dict) -> Image.Image:
+    """Composite the annotated face with a panel listing every JSON field on the right."""
+    w, h = vis_img.size
+    face_rect = api_response.get("face_rectangle", {})
+
     panel_w = min(580, w)
     line_h = 14
     composite_w = w + panel_w
@@ -127,12 +416,8 @@ def create_annotated_image(api_response: dict, image_bytes: bytes) -> bytes:
     composite.paste(vis_img, (0, 0))
 
     draw_panel = ImageDraw.Draw(composite)
-    try:
-        font_panel = ImageFont.truetype("arial.ttf", 12)
-        font_title = ImageFont.truetype("arial.ttf", 14)
-    except Exception:
-        font_panel = ImageFont.load_default()
-        font_title = font_panel
+    font_panel = _load_font(12)
+    font_title = _load_font(14)
 
     def add_section(title, items, y_start):
         draw_panel.text((w + 12, y_start), title, fill=(100, 200, 255), font=font_title)
@@ -189,73 +474,202 @@ def create_annotated_image(api_response: dict, image_bytes: bytes) -> bytes:
     if "error_detail" in api_response:
         all_items.extend(flatten(api_response["error_detail"], "error_detail"))
 
-    y = 12
-    y = add_section("FULL JSON RESPONSE (all parameters)", all_items, y)
+    add_section("FULL JSON RESPONSE (all parameters)", all_items, 12)
+    return composite
 
-    # Build regions for interactive highlighting (metric_key -> list of {left, top, width, height})
-    def rect_to_dict(rect):
-        if not rect or not isinstance(rect, dict):
-            return None
-        return {
-            "left": rect.get("left", 0),
-            "top": rect.get("top", 0),
-            "width": rect.get("width", 0),
-            "height": rect.get("height", 0),
-        }
 
-    regions = {}
+def create_annotated_image(api_response: dict, image, mode: str = "face") -> tuple:
+    """
+    Draw skin annotations on the face image.
+    image is an already-decoded RGB PIL image (drawn on in place) or raw bytes.
+    mode "face" returns just the annotated face; "panel" adds the full JSON
+    metrics panel on the right.
+    Returns (image bytes in ANNOTATED_FORMAT, regions as {key: [Rect]}, face width, face height).
+    """
+    if mode not in RENDER_MODES:
+        raise ValueError(f"Unknown render mode: {mode}")
+    if api_response.get("error_code", 0) != 0:
+        raise ValueError(api_response.get("error_msg", "API error"))
+
+    r = api_response.get("result", {})
+    face_rect = api_response.get("face_rectangle", {})
+
+    if isinstance(image, Image.Image):
+        vis_img = image if image.mode == "RGB" else image.convert("RGB")
+    else:
+        vis_img = Image.open(io.BytesIO(image)).convert("RGB")
+    draw = ImageDraw.Draw(vis_img)
+    w, h = vis_img.size
+
+    font_sm = _load_font(min(18, w // 55))
+
+    COLORS = {
+        "face": (0, 255, 255),
+        "dark_circle": (128, 0, 128),
+        "brown_spot": (139, 90, 43),
+        "comedone": (255, 255, 0),
+        "acne_mark": (255, 0, 0),
+    }
+
+    # 1. Face rectangle
     if face_rect:
-        regions["face"] = [rect_to_dict(face_rect)]
+        draw_rects(draw, [face_rect], COLORS["face"], width=4, labels=["Face"], font=font_sm)
+
+    # 2. Dark circle / eye pouch regions
     dcm = r.get("dark_circle_mark", {})
-    dark_rects = []
-    for key in ("left_eye_rect", "right_eye_rect"):
-        dr = rect_to_dict(dcm.get(key))
-        if dr:
-            dark_rects.append(dr)
-    if dark_rects:
-        regions["dark_circle"] = dark_rects
-
-    eye_pouch_rects = []
-    for key in ("left_eye_pouch_rect", "right_eye_pouch_rect"):
-        ep = rect_to_dict(r.get(key))
-        if ep:
-            eye_pouch_rects.append(ep)
-    if eye_pouch_rects:
-        regions["eye_pouch"] = eye_pouch_rects
-
-    for key, region_key in [
-        ("brown_spot", "brown_spot"),
-        ("closed_comedones", "blackhead"),
-        ("acne_mark", "acne_mark"),
-        ("acne", "acne"),
-        ("mole", "mole"),
-        ("acne_nodule", "acne_nodule"),
-        ("acne_pustule", "acne_pustule"),
-    ]:
-        rects = [rect_to_dict(x) for x in r.get(key, {}).get("rectangle", [])]
-        rects = [x for x in rects if x]
-        if rects:
-            regions[region_key] = rects
-
-    # Return face-only image (for interactive display) + regions
-    face_buffer = io.BytesIO()
-    vis_img.save(face_buffer, format="PNG")
-    face_buffer.seek(0)
-    return face_buffer.read(), regions, w, h
-
-
-def run_analysis(image_bytes: bytes) -> dict:
+    if dcm:
+        draw_rects(
+            draw,
+            [dcm.get("left_eye_rect"), dcm.get("right_eye_rect")],
+            COLORS["dark_circle"],
+            width=2,
+            labels=["Dark circle (L)", "Dark circle (R)"],
+            font=font_sm,
+        )
+
+    # 3. Brown spots
+    draw_rects(draw, r.get("brown_spot", {}).get("rectangle", []), COLORS["brown_spot"], width=2)
+
+    # 4. Closed comedones
+    draw_rects(draw, r.get("closed_comedones", {}).get("rectangle", []), COLORS["comedone"], width=2)
+
+    # 5. Acne marks + 6. Acne (same color, so one batch)
+    draw_rects(
+        draw,
+        r.get("acne_mark", {}).get("rectangle", []) + r.get("acne", {}).get("rectangle", []),
+        COLORS["acne_mark"],
+        width=2,
+    )
+
+    # Legend
+    legend_y = h - 50
+    draw.rectangle([0, legend_y, w, h], fill=(30, 30, 30))
+    draw.text(
+        (15, legend_y + 12),
+        "Cyan: Face | Purple: Dark circles | Brown: Brown spots | Yellow: Comedones | Red: Acne",
+        fill=(255, 255, 255),
+        font=font_sm,
+    )
+
+    if mode == "panel":
+        out_img = _render_metrics_panel(vis_img, api_response)
+    else:
+        out_img = vis_img
+
+    # Regions for interactive highlighting (region key -> list of Rect)
+    regions = extract_regions(api_response)
+
+    # Return the rendered image (face-only unless a panel was requested) + regions
+    return encode_image(out_img), regions, w, h
+
+
+# Pipeline stages reported to run_analysis(on_stage=...), in order. The
+# "upstream_parsed" stage carries {"metrics", "cached"} before rendering starts.
+ANALYSIS_STAGES = ("upstream_sent", "upstream_parsed", "rendered")
+
+
+class _Flight:
+    """One shared pipeline run plus the stage listeners of everyone awaiting it."""
+
+    __slots__ = ("task", "listeners", "stages", "waiters")
+
+    def __init__(self):
+        self.task = None
+        self.listeners = []
+        self.waiters = 0
+        self.stages = []  # (stage, data) reported so far, replayed to late joiners
+
+    def emit(self, stage: str, data=None):
+        self.stages.append((stage, data))
+        for listener in list(self.listeners):
+            try:
+                listener(stage, data)
+            except Exception as e:
+                logger.warning("Stage listener failed on %s: %s", stage, e)
+
+
+# Identical analyses running at the same time share one pipeline run:
+# (content key, render_mode, inline_image) -> _Flight.
+_in_flight = {}
+_coalesce_counters = {"runs": 0, "joined": 0}
+
+
+def _forget_flight(key, flight, task):
+    if _in_flight.get(key) is flight:
+        del _in_flight[key]
+    # Every waiter may have been cancelled; retrieve the outcome so a failure isn't reported as unhandled.
+    if not task.cancelled():
+        task.exception()
+
+
+async def run_analysis(image, inline_image: bool = False, render_mode: str = "face", digest: str = None,
+                       on_stage=None) -> dict:
     """
     Full analysis pipeline: call Skin Analysis Pro API and create annotated image.
-    Returns {"success": True, "metrics": {...}, "image_base64": "..."} or
+    image is the upload as bytes or a Path to the stored file; digest is its
+    content_key when the caller already computed it.
+    Returns {"success": True, "metrics": {...}, "annotated_image": b"...", ...} or
             {"success": False, "error": "..."}
+    With inline_image the annotated image is also returned as a data URL in "image_base64".
+    render_mode is passed to create_annotated_image ("panel" adds the metrics panel).
+    on_stage(stage, data) is called on the event loop as each of ANALYSIS_STAGES
+    completes (a cache hit skips "upstream_sent").
+    Concurrent calls for the same image content and options share a single
+    upstream call and rendering pass, and all receive the same result dict
+    (callers must not modify it). The run is cancelled if every caller is.
+    Raises WorkerPoolFull when the CPU pool cannot accept more work,
+    UpstreamUnavailable when the AILab API cannot be used right now and
+    InvalidImage when the upload does not decode.
     """
+    if digest is None:
+        digest = await asyncio.to_thread(file_key if isinstance(image, Path) else content_key, image)
+    key = (digest, render_mode, inline_image)
+    flight = _in_flight.get(key)
+    if flight is None:
+        flight = _Flight()
+        flight.task = asyncio.ensure_future(_run_analysis(image, inline_image, render_mode, digest, flight.emit))
+        _in_flight[key] = flight
+        flight.task.add_done_callback(functools.partial(_forget_flight, key, flight))
+        _coalesce_counters["runs"] += 1
+    else:
+        _coalesce_counters["joined"] += 1
+    if on_stage is not None:
+        for stage, data in flight.stages:
+            on_stage(stage, data)
+        flight.listeners.append(on_stage)
+    flight.waiters += 1
+    try:
+        # A waiter that goes away (client disconnect) must not cancel a run
+        # others still wait for; the last one to leave stops it.
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if on_stage is not None:
+            flight.listeners.remove(on_stage)
+        if flight.waiters == 0 and not flight.task.done():
+            # New callers start a fresh run rather than join the cancelled one.
+            if _in_flight.get(key) is flight:
+                del _in_flight[key]
+            flight.task.cancel()
+
+
+async def _run_analysis(image, inline_image: bool, render_mode: str, digest: str, emit) -> dict:
     api_key = os.environ.get("AILABAPI_API_KEY")
     if not api_key:
         return {"success": False, "error": "AILABAPI_API_KEY not configured"}
 
     try:
-        api_response = analyze_skin(image_bytes, api_key)
+        image, jpeg_data, cache_key, scale = await run_cpu(_prepare_upload, image, digest)
+    except (UnidentifiedImageError, Image.DecompressionBombError):
+        raise InvalidImage()
+    try:
+        api_response = await asyncio.to_thread(response_cache.get, cache_key)
+        cached = api_response is not None
+        if not cached:
+            emit("upstream_sent")
+            api_response = await analyze_skin(jpeg_data, api_key)
+    except (WorkerPoolFull, UpstreamUnavailable):
+        raise
     except Exception as e:
         return {"success": False, "error": str(e)}
 
@@ -264,18 +678,33 @@ def run_analysis(image_bytes: bytes) -> dict:
             "success": False,
             "error": api_response.get("error_msg", "API error"),
         }
+    if not cached:
+        await asyncio.to_thread(response_cache.put, cache_key, api_response)
+    if scale != (1.0, 1.0):
+        # The cache keeps upstream coordinates; map them to the original upload.
+        _rescale_rects(api_response, *scale)
+    emit("upstream_parsed", {"metrics": api_response, "cached": cached})
 
     try:
-        face_bytes, regions, img_w, img_h = create_annotated_image(api_response, image_bytes)
-        image_base64 = base64.b64encode(face_bytes).decode("utf-8")
+        face_bytes, regions, img_w, img_h = await run_cpu(create_annotated_image, api_response, image, render_mode)
+        emit("rendered")
+        if inline_image:
+            image_base64 = (await run_cpu(base64.b64encode, face_bytes)).decode("utf-8")
+    except WorkerPoolFull:
+        raise
     except Exception as e:
         return {"success": False, "error": f"Visualization failed: {e}"}
 
-    return {
+    result = {
         "success": True,
         "metrics": api_response,
-        "image_base64": f"data:image/png;base64,{image_base64}",
+        "annotated_image": face_bytes,
+        "image_media_type": ANNOTATED_MEDIA_TYPE,
         "regions": regions,
         "image_width": img_w,
         "image_height": img_h,
+        "cached": cached,
     }
+    if inline_image:
+        result["image_base64"] = f"data:{ANNOTATED_MEDIA_TYPE};base64,{image_base64}"
+    return result
@@ -0,0 +1,222 @@
+"""
+Content-addressed cache of AILab Skin Analysis Pro responses.
+Entries are keyed on a hash of the exact JPEG bytes sent upstream and kept in a
+small in-memory LRU tier backed by a persistent on-disk tier.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(data: bytes) -> str:
+    """Return the cache key for a blob of image bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def content_hasher():
+    """Incremental hasher; hexdigest() equals content_key() of the bytes fed to it."""
+    return hashlib.sha256()
+
+
+def file_key(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """content_key() of a file's bytes, read in chunks."""
+    hasher = content_hasher()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier LRU cache of API responses.
+    Memory tier holds up to max_entries serialized responses; disk tier holds up
+    to max_disk_bytes of JSON files. Entries older than ttl seconds are dropped.
+    """
+
+    def __init__(self, directory: Path, max_entries: int = 256,
+                 max_disk_bytes: int = 512 * 1024 * 1024, ttl: float = 7 * 24 * 3600):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (stored_at, payload bytes)
+        self._disk = OrderedDict()  # key -> (stored_at, size)
+        self._disk_bytes = 0
+        self._disk_loaded = False
+        self._lock = threading.Lock()  # guards the two indexes and counters, never held for I/O
+        self._scan_lock = threading.Lock()
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expired": 0,
+        }
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _load_disk_index(self):
+        """Scan the disk tier once, oldest first, so eviction order survives restarts."""
+        if self._disk_loaded:
+            return
+        with self._scan_lock:
+            if self._disk_loaded:
+                return
+            found = []
+            if self.max_disk_bytes > 0 and self.directory.is_dir():
+                for path in self.directory.glob("*/*.json"):
+                    try:
+                        st = path.stat()
+                    except OSError:
+                        continue
+                    found.append((st.st_mtime, path.stem, st.st_size))
+            with self._lock:
+                # Entries stored while scanning are newer than anything found.
+                stored = self._disk
+                self._disk = OrderedDict(
+                    (key, (stored_at, size)) for stored_at, key, size in sorted(found) if key not in stored
+                )
+                self._disk_bytes += sum(size for _, size in self._disk.values())
+                self._disk.update(stored)
+                evicted = self._evict_disk()
+                self._disk_loaded = True
+            self._unlink(evicted)
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def _remember(self, key: str, stored_at: float, payload: bytes):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = (stored_at, payload)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _drop_disk(self, key: str):
+        """Forget key's disk entry (caller holds the lock and unlinks the file afterwards)."""
+        _, size = self._disk.pop(key, (0, 0))
+        self._disk_bytes -= size
+
+    def _evict_disk(self) -> list:
+        """Trim the disk index to max_disk_bytes (caller holds the lock); returns keys to unlink."""
+        evicted = []
+        while self._disk and self._disk_bytes > self.max_disk_bytes:
+            key = next(iter(self._disk))
+            self._drop_disk(key)
+            evicted.append(key)
+            self._counters["evictions"] += 1
+        return evicted
+
+    def _unlink(self, keys):
+        for key in keys:
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def get(self, key: str):
+        """Return a fresh copy of the cached response for key, or None."""
+        # The lock only guards the in-memory state; files are read outside it.
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, payload = entry
+                if not self._expired(stored_at):
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                else:
+                    del self._memory[key]
+                    self._counters["expired"] += 1
+                    entry = None
+        if entry is not None:
+            return json.loads(payload)
+
+        self._load_disk_index()
+        with self._lock:
+            entry = self._disk.get(key)
+            if entry is not None and self._expired(entry[0]):
+                self._drop_disk(key)
+                self._counters["expired"] += 1
+                expired, entry = True, None
+            else:
+                expired = False
+            if entry is None:
+                self._counters["misses"] += 1
+        if expired:
+            self._unlink([key])
+        if entry is None:
+            return None
+
+        stored_at, _ = entry
+        try:
+            payload = self._path(key).read_bytes()
+            response = json.loads(payload)
+        except (OSError, ValueError) as e:
+            logger.warning("Dropping unreadable cache entry %s: %s", key, e)
+            with self._lock:
+                dropped = self._disk.get(key) == entry
+                if dropped:
+                    self._drop_disk(key)
+                self._counters["misses"] += 1
+            if dropped:
+                self._unlink([key])
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._remember(key, stored_at, payload)
+            self._counters["disk_hits"] += 1
+        return response
+
+    def put(self, key: str, response: dict):
+        """Store a response in both tiers."""
+        payload = json.dumps(response, default=str).encode("utf-8")
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, stored_at, payload)
+            self._counters["stores"] += 1
+        if self.max_disk_bytes <= 0:
+            return
+        self._load_disk_index()
+        path = self._path(key)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(payload)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Could not write cache entry %s: %s", key, e)
+            tmp.unlink(missing_ok=True)
+            return
+        with self._lock:
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)[1]
+            self._disk[key] = (stored_at, len(payload))
+            self._disk_bytes += len(payload)
+            evicted = self._evict_disk()
+        self._unlink(evicted)
+
+    def stats(self) -> dict:
+        """Counters and current tier sizes, for monitoring."""
+        with self._lock:
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+            lookups = hits + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
@@ -0,0 +1,215 @@
+"""
+Compare metrics: the fixed set of API response fields used for comparisons,
+and their extraction into compact fixed-order rows at ingest time.
+"""
+import json
+import hashlib
+
+COMPARE_KEYS = [
+    "result.skin_age",
+    "result.skin_type.skin_type",
+    "result.skin_color.skin_color_name",
+    "result.skin_color.ita_name",
+    "result.skin_color.ha_name",
+    "result.score_info.total_score",
+    "result.score_info.wrinkle_score",
+    "result.score_info.pores_score",
+    "result.score_info.blackhead_score",
+    "result.score_info.acne_score",
+    "result.score_info.dark_circle_score",
+    "result.score_info.sensitivity_score",
+    "result.score_info.brown_spot_score",
+    "result.score_info.closed_comedones_score",
+    "result.score_info.eye_bag_score",
+    "result.score_info.pigmentation_score",
+    "result.score_info.mole_score",
+    "result.score_info.texture_score",
+    "result.score_info.oil_score",
+    "result.score_info.moisture_score",
+    "result.acne.count",
+    "result.acne_mark.count",
+    "result.brown_spot.count",
+    "result.closed_comedones.count",
+    "result.mole.count",
+    "result.blackhead.count",
+    "result.blackhead.severity",
+    "result.sensitivity.area_percentage",
+    "result.sensitivity.intensity",
+    "result.dark_circle_mark.left_dark_circle_severity",
+    "result.dark_circle_mark.right_dark_circle_severity",
+    "result.dark_circle_mark.left_dark_circle_type_name",
+    "result.dark_circle_mark.right_dark_circle_type_name",
+    "result.eye_bag.severity",
+    "result.forehead_wrinkle.severity",
+    "result.left_nasolabial_fold.severity",
+    "result.right_nasolabial_fold.severity",
+    "result.left_crows_feet.severity",
+    "result.right_crows_feet.severity",
+    "result.left_eye_finelines.severity",
+    "result.right_eye_finelines.severity",
+    "result.glabellar_wrinkle.severity",
+    "result.pores_forehead.severity",
+    "result.pores_left_cheek.severity",
+    "result.pores_right_cheek.severity",
+    "result.pores_chin.severity",
+    "result.skin_type.oily_severity",
+]
+
+COMPARE_LABELS = {
+    "result.skin_age": "Skin Age",
+    "result.skin_type.skin_type": "Skin Type",
+    "result.skin_color.skin_color_name": "Skin Color",
+    "result.skin_color.ita_name": "Skin Color (ITA)",
+    "result.skin_color.ha_name": "Skin Tone (HA)",
+    "result.score_info.total_score": "Total Score",
+    "result.score_info.wrinkle_score": "Wrinkle Score",
+    "result.score_info.pores_score": "Pores Score",
+    "result.score_info.blackhead_score": "Blackhead Score",
+    "result.score_info.acne_score": "Acne Score",
+    "result.score_info.dark_circle_score": "Dark Circle Score",
+    "result.score_info.sensitivity_score": "Sensitivity Score",
+    "result.score_info.brown_spot_score": "Brown Spot Score",
+    "result.score_info.closed_comedones_score": "Comedones Score",
+    "result.score_info.eye_bag_score": "Eye Bag Score",
+    "result.score_info.pigmentation_score": "Pigmentation Score",
+    "result.score_info.mole_score": "Mole Score",
+    "result.score_info.texture_score": "Texture Score",
+    "result.score_info.oil_score": "Oil Score",
+    "result.score_info.moisture_score": "Moisture Score",
+    "result.acne.count": "Acne Count",
+    "result.acne_mark.count": "Acne Marks Count",
+    "result.brown_spot.count": "Brown Spots Count",
+    "result.closed_comedones.count": "Comedones Count",
+    "result.mole.count": "Mole Count",
+    "result.blackhead.count": "Blackhead Count",
+    "result.blackhead.severity": "Blackhead Severity",
+    "result.sensitivity.area_percentage": "Sensitivity Area %",
+    "result.sensitivity.intensity": "Sensitivity Intensity",
+    "result.dark_circle_mark.left_dark_circle_severity": "Dark Circle Severity (Left)",
+    "result.dark_circle_mark.right_dark_circle_severity": "Dark Circle Severity (Right)",
+    "result.dark_circle_mark.left_dark_circle_type_name": "Dark Circle Type (Left)",
+    "result.dark_circle_mark.right_dark_circle_type_name": "Dark Circle Type (Right)",
+    "result.eye_bag.severity": "Eye Bag Severity",
+    "result.forehead_wrinkle.severity": "Forehead Wrinkle Severity",
+    "result.left_nasolabial_fold.severity": "Nasolabial Fold Severity (Left)",
+    "result.right_nasolabial_fold.severity": "Nasolabial Fold Severity (Right)",
+    "result.left_crows_feet.severity": "Crow's Feet Severity (Left)",
+    "result.right_crows_feet.severity": "Crow's Feet Severity (Right)",
+    "result.left_eye_finelines.severity": "Eye Fine Lines Severity (Left)",
+    "result.right_eye_finelines.severity": "Eye Fine Lines Severity (Right)",
+    "result.glabellar_wrinkle.severity": "Glabellar Wrinkle Severity",
+    "result.pores_forehead.severity": "Pore Severity (Forehead)",
+    "result.pores_left_cheek.severity": "Pore Severity (Left Cheek)",
+    "result.pores_right_cheek.severity": "Pore Severity (Right Cheek)",
+    "result.pores_chin.severity": "Pore Severity (Chin)",
+    "result.skin_type.oily_severity": "Oiliness Severity",
+}
+
+COMPARE_CATEGORIES = {
+    "result.skin_age": "Skin Properties",
+    "result.skin_type.skin_type": "Skin Properties",
+    "result.skin_color.skin_color_name": "Skin Properties",
+    "result.skin_color.ita_name": "Skin Properties",
+    "result.skin_color.ha_name": "Skin Properties",
+    "result.skin_type.oily_severity": "Skin Properties",
+    "result.score_info.total_score": "Scores",
+    "result.score_info.wrinkle_score": "Scores",
+    "result.score_info.pores_score": "Scores",
+    "result.score_info.blackhead_score": "Scores",
+    "result.score_info.acne_score": "Scores",
+    "result.score_info.dark_circle_score": "Scores",
+    "result.score_info.sensitivity_score": "Scores",
+    "result.score_info.brown_spot_score": "Scores",
+    "result.score_info.closed_comedones_score": "Scores",
+    "result.score_info.eye_bag_score": "Scores",
+    "result.score_info.pigmentation_score": "Scores",
+    "result.score_info.mole_score": "Scores",
+    "result.score_info.texture_score": "Scores",
+    "result.score_info.oil_score": "Scores",
+    "result.score_info.moisture_score": "Scores",
+    "result.acne.count": "Counts",
+    "result.acne_mark.count": "Counts",
+    "result.brown_spot.count": "Counts",
+    "result.closed_comedones.count": "Counts",
+    "result.mole.count": "Counts",
+    "result.blackhead.count": "Counts",
+    "result.blackhead.severity": "Severity",
+    "result.sensitivity.area_percentage": "Sensitivity",
+    "result.sensitivity.intensity": "Sensitivity",
+    "result.dark_circle_mark.left_dark_circle_severity": "Eye Area",
+    "result.dark_circle_mark.right_dark_circle_severity": "Eye Area",
+    "result.dark_circle_mark.left_dark_circle_type_name": "Eye Area",
+    "result.dark_circle_mark.right_dark_circle_type_name": "Eye Area",
+    "result.eye_bag.severity": "Eye Area",
+    "result.forehead_wrinkle.severity": "Wrinkles",
+    "result.left_nasolabial_fold.severity": "Wrinkles",
+    "result.right_nasolabial_fold.severity": "Wrinkles",
+    "result.left_crows_feet.severity": "Wrinkles",
+    "result.right_crows_feet.severity": "Wrinkles",
+    "result.left_eye_finelines.severity": "Wrinkles",
+    "result.right_eye_finelines.severity": "Wrinkles",
+    "result.glabellar_wrinkle.severity": "Wrinkles",
+    "result.pores_forehead.severity": "Pores",
+    "result.pores_left_cheek.severity": "Pores",
+    "result.pores_right_cheek.severity": "Pores",
+    "result.pores_chin.severity": "Pores",
+}
+
+HIGHER_IS_BETTER = {
+    "result.score_info.total_score",
+    "result.score_info.wrinkle_score",
+    "result.score_info.pores_score",
+    "result.score_info.blackhead_score",
+    "result.score_info.acne_score",
+    "result.score_info.dark_circle_score",
+    "result.score_info.sensitivity_score",
+    "result.score_info.brown_spot_score",
+    "result.score_info.closed_comedones_score",
+    "result.score_info.eye_bag_score",
+    "result.score_info.pigmentation_score",
+    "result.score_info.mole_score",
+    "result.score_info.texture_score",
+    "result.score_info.oil_score",
+    "result.score_info.moisture_score",
+}
+
+LOWER_IS_BETTER = {
+    "result.skin_age",
+    "result.acne.count",
+    "result.acne_mark.count",
+    "result.brown_spot.count",
+    "result.closed_comedones.count",
+    "result.blackhead.count",
+    "result.sensitivity.area_percentage",
+    "result.sensitivity.intensity",
+}
+
+
+# Dotted keys split once; row position i always holds COMPARE_KEYS[i].
+COMPARE_PATHS = tuple(tuple(key.split(".")) for key in COMPARE_KEYS)
+
+# Fingerprint of the row layout; stored rows with another schema are rebuilt.
+ROW_SCHEMA = hashlib.sha1("\n".join(COMPARE_KEYS).encode("utf-8")).hexdigest()[:12]
+
+
+def extract_row(metrics: dict) -> tuple:
+    """Pull every COMPARE_KEYS value out of a raw API response, in key order."""
+    row = []
+    for path in COMPARE_PATHS:
+        cur = metrics
+        for p in path:
+            if not isinstance(cur, dict):
+                cur = None
+                break
+            cur = cur.get(p)
+        row.append(cur)
+    return tuple(row)
+
+
+def encode_row(row: tuple) -> str:
+    """Serialize a row as a compact JSON array, preserving each value's JSON type."""
+    return json.dumps(row, separators=(",", ":"))
+
+
+def decode_row(data: str) -> tuple:
+    return tuple(json.loads(data))
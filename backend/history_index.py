@@ -0,0 +1,277 @@
+"""
+Embedded SQLite index of stored analyses.
+Updated when an analysis is written so /history and /compare can answer without
+globbing and parsing records; backfilled from the JSON records on startup.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+from compare_rows import ROW_SCHEMA, extract_row, encode_row, decode_row
+from records import find_upload, media_type_for
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL DEFAULT '',
+    image_file TEXT NOT NULL DEFAULT '',
+    skin_type,
+    total_score REAL
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_timestamp ON analyses (timestamp);
+CREATE TABLE IF NOT EXISTS compare_rows (
+    id TEXT PRIMARY KEY,
+    schema TEXT NOT NULL,
+    row TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    file TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    PRIMARY KEY (id, kind)
+);
+"""
+
+
+def _index_row(record: dict) -> tuple:
+    metrics = record.get("metrics") or {}
+    result = metrics.get("result") or {}
+    skin_type = (result.get("skin_type") or {}).get("skin_type")
+    total_score = (result.get("score_info") or {}).get("total_score")
+    if not isinstance(total_score, (int, float)):
+        total_score = None
+    return (
+        record["id"],
+        record.get("timestamp") or "",
+        record.get("image_file") or "",
+        skin_type,
+        total_score,
+    )
+
+
+def _record_artifacts(record: dict) -> dict:
+    """kind -> (filename, media_type) for the artifacts a record lists."""
+    found = {}
+    for kind, info in (record.get("artifacts") or {}).items():
+        if isinstance(info, dict) and info.get("file"):
+            found[kind] = (info["file"], info.get("media_type") or media_type_for(info["file"]))
+    if "upload" not in found and record.get("image_file"):
+        found["upload"] = (record["image_file"], media_type_for(record["image_file"]))
+    return found
+
+
+class HistoryIndex:
+    """
+    SQLite (WAL mode) index with one connection per thread.
+    Artifact locations are also mirrored in memory so repeat lookups touch
+    neither the database nor the filesystem. The mirror is per process, so a
+    miss falls back to the database to pick up rows written by other workers.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self._artifacts = {}  # id -> {kind: (filename, media_type)}
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def upsert(self, record: dict):
+        """Add or replace the index row and compare row for a stored record."""
+        row = encode_row(extract_row(record.get("metrics") or {}))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (id, timestamp, image_file, skin_type, total_score) "
+                "VALUES (?, ?, ?, ?, ?)",
+                _index_row(record),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO compare_rows (id, schema, row) VALUES (?, ?, ?)",
+                (record["id"], ROW_SCHEMA, row),
+            )
+            for kind, (filename, media_type) in _record_artifacts(record).items():
+                self._put_artifact(conn, record["id"], kind, filename, media_type)
+
+    def _put_artifact(self, conn, analysis_id: str, kind: str, filename: str, media_type: str):
+        conn.execute(
+            "INSERT OR REPLACE INTO artifacts (id, kind, file, media_type) VALUES (?, ?, ?, ?)",
+            (analysis_id, kind, filename, media_type),
+        )
+        self._artifacts.setdefault(analysis_id, {})[kind] = (filename, media_type)
+
+    def add_artifact(self, analysis_id: str, kind: str, filename: str, media_type: str):
+        """Record an artifact created after ingest (e.g. a lazily built thumbnail)."""
+        with self._connect() as conn:
+            self._put_artifact(conn, analysis_id, kind, filename, media_type)
+
+    def remove_artifact(self, analysis_id: str, kind: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifacts WHERE id = ? AND kind = ?", (analysis_id, kind))
+        self._artifacts.get(analysis_id, {}).pop(kind, None)
+
+    def artifact(self, analysis_id: str, kind: str):
+        """(filename, media_type) of a stored artifact, or None. No I/O on a memory hit."""
+        hit = self._artifacts.get(analysis_id, {}).get(kind)
+        if hit is None:
+            row = self._connect().execute(
+                "SELECT file, media_type FROM artifacts WHERE id = ? AND kind = ?",
+                (analysis_id, kind),
+            ).fetchone()
+            if row is not None:
+                # Only found rows are cached; a thumbnail missing now may be
+                # created by another worker later.
+                hit = (row[0], row[1])
+                self._artifacts.setdefault(analysis_id, {})[kind] = hit
+        return hit
+
+    def is_indexed(self, analysis_id: str) -> bool:
+        if analysis_id in self._artifacts:
+            return True
+        row = self._connect().execute("SELECT 1 FROM analyses WHERE id = ?", (analysis_id,)).fetchone()
+        if row is None:
+            return False
+        self._artifacts.setdefault(analysis_id, {})
+        return True
+
+    def warm_artifacts(self):
+        """Load every artifact location into memory."""
+        artifacts = {}
+        for row in self._connect().execute("SELECT a.id, r.kind, r.file, r.media_type FROM analyses a "
+                                           "LEFT JOIN artifacts r ON r.id = a.id"):
+            kinds = artifacts.setdefault(row[0], {})
+            if row[1] is not None:
+                kinds[row[1]] = (row[2], row[3])
+        self._artifacts = artifacts
+
+    def compare_row(self, analysis_id: str):
+        """Return (timestamp, row) for an analysis, or None if not indexed."""
+        hit = self._connect().execute(
+            "SELECT a.timestamp, c.row FROM analyses a JOIN compare_rows c ON c.id = a.id "
+            "WHERE a.id = ? AND c.schema = ?",
+            (analysis_id, ROW_SCHEMA),
+        ).fetchone()
+        if hit is None:
+            return None
+        return hit[0], decode_row(hit[1])
+
+    def page(self, limit: int, before_id=None, since=None, until=None,
+             skin_type=None, min_score=None, max_score=None) -> tuple:
+        """
+        One page of analyses, newest first, optionally filtered.
+        since/until are ISO timestamps (since inclusive, until exclusive).
+        Returns (entries, last_id); last_id is None when there are no more rows.
+        """
+        clauses, params = [], []
+        if before_id is not None:
+            clauses.append("id < ?")
+            params.append(before_id)
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        if skin_type is not None:
+            clauses.append("CAST(skin_type AS TEXT) = ?")
+            params.append(str(skin_type))
+        if min_score is not None:
+            clauses.append("total_score >= ?")
+            params.append(min_score)
+        if max_score is not None:
+            clauses.append("total_score <= ?")
+            params.append(max_score)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        rows = self._connect().execute(
+            f"SELECT id, timestamp, image_file FROM analyses {where}ORDER BY id DESC LIMIT ?",
+            (*params, limit + 1),
+        ).fetchall()
+        entries = [dict(row) for row in rows[:limit]]
+        last_id = entries[-1]["id"] if len(rows) > limit else None
+        return entries, last_id
+
+    def compare_rows(self, ids=None, since=None, until=None, after_id=None, limit: int = 500) -> tuple:
+        """
+        (id, timestamp, row) for the given IDs, or for every analysis in the
+        since/until range, oldest first, starting after after_id.
+        Returns (rows, last_id); last_id is None unless more than limit rows matched.
+        """
+        clauses, params = ["c.schema = ?"], [ROW_SCHEMA]
+        if ids is not None:
+            clauses.append(f"a.id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        if since:
+            clauses.append("a.timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("a.timestamp < ?")
+            params.append(until)
+        if after_id is not None:
+            clauses.append("a.id > ?")
+            params.append(after_id)
+        rows = self._connect().execute(
+            "SELECT a.id, a.timestamp, c.row FROM analyses a JOIN compare_rows c ON c.id = a.id "
+            f"WHERE {' AND '.join(clauses)} ORDER BY a.id LIMIT ?",
+            (*params, limit + 1),
+        ).fetchall()
+        out = [(r[0], r[1], decode_row(r[2])) for r in rows[:limit]]
+        last_id = out[-1][0] if len(rows) > limit else None
+        return out, last_id
+
+    def backfill(self, uploads_dir: Path) -> int:
+        """Index records missing from the database and drop rows whose record is gone."""
+        on_disk = {p.stem: p for p in Path(uploads_dir).glob("*.json")}
+        conn = self._connect()
+        indexed = {row[0] for row in conn.execute("SELECT id FROM analyses")}
+        # Rows extracted with an older COMPARE_KEYS layout are rebuilt too.
+        current_rows = {
+            row[0] for row in conn.execute("SELECT id FROM compare_rows WHERE schema = ?", (ROW_SCHEMA,))
+        }
+        with_upload = {
+            row[0] for row in conn.execute("SELECT id FROM artifacts WHERE kind = 'upload'")
+        }
+        # Records indexed before artifacts were tracked are revisited as well.
+        missing = (on_disk.keys() - indexed) | (on_disk.keys() - current_rows) | (on_disk.keys() - with_upload)
+
+        added = 0
+        for analysis_id in sorted(missing):
+            path = on_disk[analysis_id]
+            try:
+                record = json.loads(path.read_text(encoding="utf-8"))
+            except Exception as e:
+                logger.warning("Skipping unreadable record %s: %s", path.name, e)
+                continue
+            record["id"] = analysis_id
+            if "upload" not in _record_artifacts(record):
+                upload = find_upload(Path(uploads_dir), analysis_id)
+                if upload:
+                    record["image_file"] = upload.name
+            self.upsert(record)
+            added += 1
+
+        stale = indexed - on_disk.keys()
+        if stale:
+            with conn:
+                conn.executemany("DELETE FROM analyses WHERE id = ?", [(i,) for i in stale])
+                conn.executemany("DELETE FROM compare_rows WHERE id = ?", [(i,) for i in stale])
+                conn.executemany("DELETE FROM artifacts WHERE id = ?", [(i,) for i in stale])
+        # Uploads are indexed on receipt; drop those whose analysis never got a record.
+        with conn:
+            conn.execute("DELETE FROM artifacts WHERE id NOT IN (SELECT id FROM analyses)")
+        if added or stale:
+            logger.info("History index: %d indexed, %d removed", added, len(stale))
+        self.warm_artifacts()
+        return added
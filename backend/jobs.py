@@ -0,0 +1,154 @@
+"""
+In-process registry of background analysis jobs.
+A job records an ordered list of events (status changes and pipeline stages,
+then a final "result" or "failed"); pollers read its current state and server-sent-event
+streams replay the events and wait for new ones. Finished jobs are kept for
+a limited time. Jobs live in the process that accepted them, so with several
+server workers the /jobs endpoints need sticky routing.
+"""
+import time
+import asyncio
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+
+class JobQueueFull(Exception):
+    """Raised when max_queued jobs are already waiting for a slot."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Too many analyses queued, please retry shortly")
+        self.retry_after = retry_after
+
+
+class Job:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.events = [("status", {"status": "queued"})]
+        self._changed = asyncio.Event()
+
+    def publish(self, event: str, data: dict):
+        self.events.append((event, data))
+        # Wake every current waiter; later waiters get a fresh Event.
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def stage(self, name: str):
+        """Report a pipeline stage (see analyzer.ANALYSIS_STAGES) with seconds since submission."""
+        self.publish("stage", {"stage": name, "elapsed": round(time.time() - self.created, 3)})
+
+    def start(self):
+        self.status = "running"
+        self.publish("status", {"status": "running"})
+
+    def finish(self, result: dict):
+        self.status, self.result, self.finished = "done", result, time.time()
+        self.publish("result", result)
+
+    def fail(self, status_code: int, detail, retry_after=None):
+        self.error = {"status": status_code, "detail": detail}
+        if retry_after is not None:
+            self.error["retry_after"] = retry_after
+        self.status, self.finished = "failed", time.time()
+        self.publish("failed", self.error)
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    async def wait_for_events(self, since: int, timeout: float) -> list:
+        """Events after index since, waiting up to timeout seconds for one to arrive."""
+        if len(self.events) <= since and not self.done:
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.events[since:]
+
+    def to_dict(self) -> dict:
+        out = {"id": self.id, "status": self.status}
+        if self.result is not None:
+            out["result"] = self.result
+        if self.error is not None:
+            out["error"] = self.error
+        return out
+
+
+class JobRegistry:
+    """
+    Jobs by ID. Each job's coroutine runs as a task, at most `concurrency` at a
+    time with at most `max_queued` waiting; finished jobs are dropped ttl
+    seconds after they end.
+    """
+
+    def __init__(self, concurrency: int, ttl: float, max_queued: int, retry_after: int = 2):
+        self.ttl = ttl
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self._jobs = {}
+        self._tasks = set()
+        self._queued = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._counters = {"submitted": 0, "done": 0, "failed": 0, "rejected": 0}
+
+    def check_capacity(self):
+        """Raise JobQueueFull if a new job would exceed max_queued."""
+        if self._queued >= self.max_queued:
+            self._counters["rejected"] += 1
+            raise JobQueueFull(self.retry_after)
+
+    def submit(self, job_id: str, run) -> Job:
+        """
+        Register a job and start run(job) in the background once a slot is
+        free. run must call job.finish() or job.fail(). Raises JobQueueFull
+        when the queue is at max_queued.
+        """
+        self._prune()
+        self.check_capacity()
+        job = Job(job_id)
+        self._jobs[job_id] = job
+        self._queued += 1
+        self._counters["submitted"] += 1
+
+        async def runner():
+            try:
+                await self._slots.acquire()
+            finally:
+                self._queued -= 1
+            try:
+                job.start()
+                await run(job)
+            finally:
+                self._slots.release()
+            self._counters["done" if job.status == "done" else "failed"] += 1
+
+        task = asyncio.ensure_future(runner())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, job_id: str):
+        self._prune()
+        return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j.id for j in self._jobs.values() if j.done and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    async def shutdown(self):
+        """Cancel jobs still queued or running."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        counts = {state: 0 for state in JOB_STATES}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return {**self._counters, "queued": self._queued, "max_queued": self.max_queued, "tracked": counts}
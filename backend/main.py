@@ -5,11 +5,15 @@ Serves the Web_app/ frontend as static files.
 """
 import os
 import json
+import base64
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
-from datetime import datetime
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse
+from datetime import datetime, timedelta
+from typing import List, Optional
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,15 +21,97 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 
-from analyzer import run_analysis
+from analyzer import (
+    run_analysis,
+    open_upstream_client,
+    close_upstream_client,
+    create_thumbnail,
+    THUMB_EXT,
+    THUMB_MEDIA_TYPE,
+    WorkerPoolFull,
+    UpstreamUnavailable,
+    InvalidImage,
+    response_cache,
+    upstream_stats,
+)
+from cache import content_hasher
+from compare_rows import (
+    COMPARE_KEYS,
+    COMPARE_LABELS,
+    COMPARE_CATEGORIES,
+    HIGHER_IS_BETTER,
+    LOWER_IS_BETTER,
+    extract_row,
+)
+from history_index import HistoryIndex
+from records import (
+    UPLOAD_EXTENSIONS,
+    build_record,
+    serialize_record,
+    backfill_record,
+    extension_for,
+    media_type_for,
+    new_analysis_id,
+)
+from persistence import BackgroundWriter
+from jobs import JobRegistry, JobQueueFull
+from regions import REGION_FORMATS, encode_regions, regions_from_dicts
 
 load_dotenv()
 
-app = FastAPI(title="Skin Analysis API")
 
 UPLOADS_DIR = Path(__file__).resolve().parent / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+history_index = HistoryIndex(UPLOADS_DIR / "history.db")
+
+# Annotated images and records are written off the request path; writes that
+# arrive within PERSIST_BATCH_MS of each other share one flush.
+PERSIST_BATCH_MS = float(os.environ.get("PERSIST_BATCH_MS", "20"))
+record_writer = BackgroundWriter(batch_window=PERSIST_BATCH_MS / 1000)
+
+# Images larger than MAX_UPLOAD_MB are rejected with 413. Requests whose
+# Content-Length already exceeds the limit (plus multipart framing) are refused
+# before the body is read; Starlette spools the rest to a temporary file,
+# which is copied to uploads/ in chunks and hashed on the way.
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", "20")) * 1024 * 1024)
+MULTIPART_OVERHEAD = 64 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# /analyze/batch: images per request, and how many are analyzed at once.
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "20"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+
+# /analyze?job=true: pipelines run in the background, JOB_CONCURRENCY at a
+# time with up to JOB_MAX_QUEUED waiting (more are refused with 503); finished
+# jobs stay queryable for JOB_TTL seconds. Event streams send a keep-alive
+# comment every JOB_HEARTBEAT seconds while idle. Jobs are held in memory by
+# the worker that accepted them: run several workers only behind sticky routing.
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "4"))
+JOB_MAX_QUEUED = int(os.environ.get("JOB_MAX_QUEUED", str(JOB_CONCURRENCY * 8)))
+JOB_TTL = float(os.environ.get("JOB_TTL", "600"))
+JOB_HEARTBEAT = float(os.environ.get("JOB_HEARTBEAT", "15"))
+
+analysis_jobs = JobRegistry(concurrency=JOB_CONCURRENCY, ttl=JOB_TTL, max_queued=JOB_MAX_QUEUED)
+
+# Region encodings accepted by ?regions= (see regions.encode_regions)
+REGION_FORMAT_PATTERN = f"^({'|'.join(REGION_FORMATS)})$"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(history_index.backfill, UPLOADS_DIR)
+    await open_upstream_client()
+    try:
+        yield
+    finally:
+        await analysis_jobs.shutdown()
+        await close_upstream_client()
+        await asyncio.to_thread(record_writer.close)
+
+
+app = FastAPI(title="Skin Analysis API", lifespan=lifespan)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -35,195 +121,116 @@ app.add_middleware(
 )
 
 
-COMPARE_KEYS = [
-    "result.skin_age",
-    "result.skin_type.skin_type",
-    "result.skin_color.skin_color_name",
-    "result.skin_color.ita_name",
-    "result.skin_color.ha_name",
-    "result.score_info.total_score",
-    "result.score_info.wrinkle_score",
-    "result.score_info.pores_score",
-    "result.score_info.blackhead_score",
-    "result.score_info.acne_score",
-    "result.score_info.dark_circle_score",
-    "result.score_info.sensitivity_score",
-    "result.score_info.brown_spot_score",
-    "result.score_info.closed_comedones_score",
-    "result.score_info.eye_bag_score",
-    "result.score_info.pigmentation_score",
-    "result.score_info.mole_score",
-    "result.score_info.texture_score",
-    "result.score_info.oil_score",
-    "result.score_info.moisture_score",
-    "result.acne.count",
-    "result.acne_mark.count",
-    "result.brown_spot.count",
-    "result.closed_comedones.count",
-    "result.mole.count",
-    "result.blackhead.count",
-    "result.blackhead.severity",
-    "result.sensitivity.area_percentage",
-    "result.sensitivity.intensity",
-    "result.dark_circle_mark.left_dark_circle_severity",
-    "result.dark_circle_mark.right_dark_circle_severity",
-    "result.dark_circle_mark.left_dark_circle_type_name",
-    "result.dark_circle_mark.right_dark_circle_type_name",
-    "result.eye_bag.severity",
-    "result.forehead_wrinkle.severity",
-    "result.left_nasolabial_fold.severity",
-    "result.right_nasolabial_fold.severity",
-    "result.left_crows_feet.severity",
-    "result.right_crows_feet.severity",
-    "result.left_eye_finelines.severity",
-    "result.right_eye_finelines.severity",
-    "result.glabellar_wrinkle.severity",
-    "result.pores_forehead.severity",
-    "result.pores_left_cheek.severity",
-    "result.pores_right_cheek.severity",
-    "result.pores_chin.severity",
-    "result.skin_type.oily_severity",
-]
-
-COMPARE_LABELS = {
-    "result.skin_age": "Skin Age",
-    "result.skin_type.skin_type": "Skin Type",
-    "result.skin_color.skin_color_name": "Skin Color",
-    "result.skin_color.ita_name": "Skin Color (ITA)",
-    "result.skin_color.ha_name": "Skin Tone (HA)",
-    "result.score_info.total_score": "Total Score",
-    "result.score_info.wrinkle_score": "Wrinkle Score",
-    "result.score_info.pores_score": "Pores Score",
-    "result.score_info.blackhead_score": "Blackhead Score",
-    "result.score_info.acne_score": "Acne Score",
-    "result.score_info.dark_circle_score": "Dark Circle Score",
-    "result.score_info.sensitivity_score": "Sensitivity Score",
-    "result.score_info.brown_spot_score": "Brown Spot Score",
-    "result.score_info.closed_comedones_score": "Comedones Score",
-    "result.score_info.eye_bag_score": "Eye Bag Score",
-    "result.score_info.pigmentation_score": "Pigmentation Score",
-    "result.score_info.mole_score": "Mole Score",
-    "result.score_info.texture_score": "Texture Score",
-    "result.score_info.oil_score": "Oil Score",
-    "result.score_info.moisture_score": "Moisture Score",
-    "result.acne.count": "Acne Count",
-    "result.acne_mark.count": "Acne Marks Count",
-    "result.brown_spot.count": "Brown Spots Count",
-    "result.closed_comedones.count": "Comedones Count",
-    "result.mole.count": "Mole Count",
-    "result.blackhead.count": "Blackhead Count",
-    "result.blackhead.severity": "Blackhead Severity",
-    "result.sensitivity.area_percentage": "Sensitivity Area %",
-    "result.sensitivity.intensity": "Sensitivity Intensity",
-    "result.dark_circle_mark.left_dark_circle_severity": "Dark Circle Severity (Left)",
-    "result.dark_circle_mark.right_dark_circle_severity": "Dark Circle Severity (Right)",
-    "result.dark_circle_mark.left_dark_circle_type_name": "Dark Circle Type (Left)",
-    "result.dark_circle_mark.right_dark_circle_type_name": "Dark Circle Type (Right)",
-    "result.eye_bag.severity": "Eye Bag Severity",
-    "result.forehead_wrinkle.severity": "Forehead Wrinkle Severity",
-    "result.left_nasolabial_fold.severity": "Nasolabial Fold Severity (Left)",
-    "result.right_nasolabial_fold.severity": "Nasolabial Fold Severity (Right)",
-    "result.left_crows_feet.severity": "Crow's Feet Severity (Left)",
-    "result.right_crows_feet.severity": "Crow's Feet Severity (Right)",
-    "result.left_eye_finelines.severity": "Eye Fine Lines Severity (Left)",
-    "result.right_eye_finelines.severity": "Eye Fine Lines Severity (Right)",
-    "result.glabellar_wrinkle.severity": "Glabellar Wrinkle Severity",
-    "result.pores_forehead.severity": "Pore Severity (Forehead)",
-    "result.pores_left_cheek.severity": "Pore Severity (Left Cheek)",
-    "result.pores_right_cheek.severity": "Pore Severity (Right Cheek)",
-    "result.pores_chin.severity": "Pore Severity (Chin)",
-    "result.skin_type.oily_severity": "Oiliness Severity",
-}
-
-COMPARE_CATEGORIES = {
-    "result.skin_age": "Skin Properties",
-    "result.skin_type.skin_type": "Skin Properties",
-    "result.skin_color.skin_color_name": "Skin Properties",
-    "result.skin_color.ita_name": "Skin Properties",
-    "result.skin_color.ha_name": "Skin Properties",
-    "result.skin_type.oily_severity": "Skin Properties",
-    "result.score_info.total_score": "Scores",
-    "result.score_info.wrinkle_score": "Scores",
-    "result.score_info.pores_score": "Scores",
-    "result.score_info.blackhead_score": "Scores",
-    "result.score_info.acne_score": "Scores",
-    "result.score_info.dark_circle_score": "Scores",
-    "result.score_info.sensitivity_score": "Scores",
-    "result.score_info.brown_spot_score": "Scores",
-    "result.score_info.closed_comedones_score": "Scores",
-    "result.score_info.eye_bag_score": "Scores",
-    "result.score_info.pigmentation_score": "Scores",
-    "result.score_info.mole_score": "Scores",
-    "result.score_info.texture_score": "Scores",
-    "result.score_info.oil_score": "Scores",
-    "result.score_info.moisture_score": "Scores",
-    "result.acne.count": "Counts",
-    "result.acne_mark.count": "Counts",
-    "result.brown_spot.count": "Counts",
-    "result.closed_comedones.count": "Counts",
-    "result.mole.count": "Counts",
-    "result.blackhead.count": "Counts",
-    "result.blackhead.severity": "Severity",
-    "result.sensitivity.area_percentage": "Sensitivity",
-    "result.sensitivity.intensity": "Sensitivity",
-    "result.dark_circle_mark.left_dark_circle_severity": "Eye Area",
-    "result.dark_circle_mark.right_dark_circle_severity": "Eye Area",
-    "result.dark_circle_mark.left_dark_circle_type_name": "Eye Area",
-    "result.dark_circle_mark.right_dark_circle_type_name": "Eye Area",
-    "result.eye_bag.severity": "Eye Area",
-    "result.forehead_wrinkle.severity": "Wrinkles",
-    "result.left_nasolabial_fold.severity": "Wrinkles",
-    "result.right_nasolabial_fold.severity": "Wrinkles",
-    "result.left_crows_feet.severity": "Wrinkles",
-    "result.right_crows_feet.severity": "Wrinkles",
-    "result.left_eye_finelines.severity": "Wrinkles",
-    "result.right_eye_finelines.severity": "Wrinkles",
-    "result.glabellar_wrinkle.severity": "Wrinkles",
-    "result.pores_forehead.severity": "Pores",
-    "result.pores_left_cheek.severity": "Pores",
-    "result.pores_right_cheek.severity": "Pores",
-    "result.pores_chin.severity": "Pores",
-}
-
-HIGHER_IS_BETTER = {
-    "result.score_info.total_score",
-    "result.score_info.wrinkle_score",
-    "result.score_info.pores_score",
-    "result.score_info.blackhead_score",
-    "result.score_info.acne_score",
-    "result.score_info.dark_circle_score",
-    "result.score_info.sensitivity_score",
-    "result.score_info.brown_spot_score",
-    "result.score_info.closed_comedones_score",
-    "result.score_info.eye_bag_score",
-    "result.score_info.pigmentation_score",
-    "result.score_info.mole_score",
-    "result.score_info.texture_score",
-    "result.score_info.oil_score",
-    "result.score_info.moisture_score",
-}
-
-LOWER_IS_BETTER = {
-    "result.skin_age",
-    "result.acne.count",
-    "result.acne_mark.count",
-    "result.brown_spot.count",
-    "result.closed_comedones.count",
-    "result.blackhead.count",
-    "result.sensitivity.area_percentage",
-    "result.sensitivity.intensity",
-}
-
-
-def _get_nested(obj, dotted_key):
-    """Safely traverse a nested dict by dotted key."""
-    parts = dotted_key.split(".")
-    cur = obj
-    for p in parts:
-        if not isinstance(cur, dict):
-            return None
-        cur = cur.get(p)
-    return cur
+def _max_request_bytes(path: str):
+    """Largest acceptable body for an upload endpoint, or None for other paths."""
+    if path == "/analyze":
+        return MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD
+    if path == "/analyze/batch":
+        return BATCH_MAX_FILES * (MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD)
+    return None
+
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Refuse oversized uploads from Content-Length, before the multipart body is parsed."""
+    limit = _max_request_bytes(request.url.path) if request.method == "POST" else None
+    length = request.headers.get("content-length")
+    if limit is not None and length and length.isdigit() and int(length) > limit:
+        logger.warning("Rejected: request body of %s bytes exceeds %d", length, limit)
+        limit_mb = f"{MAX_UPLOAD_BYTES / (1024 * 1024):g} MB"
+        detail = (f"Image is larger than the {limit_mb} limit" if request.url.path == "/analyze"
+                  else f"Batch is larger than {BATCH_MAX_FILES} images of {limit_mb}")
+        return JSONResponse(status_code=413, content={"detail": detail})
+    return await call_next(request)
+
+
+# Stored artifacts never change for a given analysis ID.
+ARTIFACT_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def _etag_matches(if_none_match, etag):
+    """Check an If-None-Match header value against an ETag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [t.strip() for t in if_none_match.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+def _artifact_response(request: Request, path: Path, media_type: str, immutable: bool = True):
+    """
+    Serve a stored file with ETag / If-None-Match support and long-lived caching.
+    immutable=False serves it for this URL only until revalidated, without an ETag.
+    """
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        pending = record_writer.pending(path)
+        if pending is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        # Still queued on the background writer; its ETag would differ once stored.
+        return Response(content=pending, media_type=media_type)
+    if not immutable:
+        response = FileResponse(path, media_type=media_type, headers={"Cache-Control": "no-cache"},
+                                stat_result=st)
+        del response.headers["etag"]
+        return response
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": ARTIFACT_CACHE_CONTROL}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=st)
+
+
+def _read_record(analysis_id: str) -> dict:
+    """Load a stored record, including one still queued for writing. Raises FileNotFoundError."""
+    json_path = UPLOADS_DIR / f"{analysis_id}.json"
+    pending = record_writer.pending(json_path)
+    if pending is not None:
+        return json.loads(pending)
+    return json.loads(json_path.read_text(encoding="utf-8"))
+
+
+def _artifact(analysis_id: str, kind: str):
+    """(path, media_type) of a stored artifact from the history index, or None."""
+    hit = history_index.artifact(analysis_id, kind)
+    if hit is None:
+        return None
+    return UPLOADS_DIR / hit[0], hit[1]
+
+
+async def _spool_upload(upload: UploadFile, dest: Path) -> tuple:
+    """
+    Copy an upload (already spooled by Starlette) to dest in UPLOAD_CHUNK_SIZE
+    chunks, hashing as it goes.
+    Returns (size, content key). Nothing is left at dest if the upload is
+    empty, too large (413) or fails part way.
+    """
+    hasher = content_hasher()
+    size = 0
+    tmp = dest.with_name(dest.name + ".part")
+    f = await asyncio.to_thread(open, tmp, "wb")
+    try:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Image is larger than the {MAX_UPLOAD_BYTES / (1024 * 1024):g} MB limit",
+                )
+            hasher.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        f.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    f.close()
+    if size:
+        os.replace(tmp, dest)
+    else:
+        tmp.unlink(missing_ok=True)
+    return size, hasher.hexdigest()
 
 
 def _judge_change(key, before_val, after_val):
@@ -239,216 +246,485 @@ def _judge_change(key, before_val, after_val):
     return "changed"
 
 
-@app.post("/analyze")
-async def analyze(image: UploadFile = File(..., description="Image file (JPEG/PNG)")):
-    """Accept image upload, run skin analysis, return metrics and annotated image."""
-    logger.info("=== INCOMING REQUEST ===")
+async def _receive_upload(image: UploadFile) -> tuple:
+    """Validate and store one uploaded image. Returns (analysis_id, upload path, content key)."""
     logger.info("Filename: %s | Content-Type: %s", image.filename, image.content_type)
 
     if image.content_type and not image.content_type.startswith("image/"):
         logger.warning("Rejected: not an image (content-type: %s)", image.content_type)
         raise HTTPException(status_code=400, detail="File must be an image (JPEG or PNG)")
 
+    analysis_id = new_analysis_id()
+    ext = Path(image.filename).suffix if image.filename else ".jpg"
+    if ext.lower() not in UPLOAD_EXTENSIONS:
+        ext = ".jpg"
+    img_path = UPLOADS_DIR / f"{analysis_id}{ext}"
     try:
-        image_bytes = await image.read()
+        size, digest = await _spool_upload(image, img_path)
+    except HTTPException:
+        logger.warning("Rejected: upload larger than %d bytes", MAX_UPLOAD_BYTES)
+        raise
     except Exception as e:
         logger.error("Failed to read file: %s", e)
         raise HTTPException(status_code=400, detail=f"Failed to read file: {e}")
 
-    logger.info("Received image: %d bytes", len(image_bytes))
+    logger.info("Received image: %d bytes", size)
 
-    if len(image_bytes) == 0:
+    if size == 0:
         logger.warning("Rejected: empty file")
         raise HTTPException(status_code=400, detail="Empty file")
 
-    analysis_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-    ext = Path(image.filename).suffix if image.filename else ".jpg"
-    if ext.lower() not in (".jpg", ".jpeg", ".png", ".webp"):
-        ext = ".jpg"
-    img_path = UPLOADS_DIR / f"{analysis_id}{ext}"
-    try:
-        img_path.write_bytes(image_bytes)
-        logger.info("Saved upload to %s", img_path)
-    except Exception as e:
-        logger.warning("Could not save upload: %s", e)
+    logger.info("Saved upload to %s", img_path)
+    # Index the upload now so /image and /thumb work before the record is written.
+    await asyncio.to_thread(history_index.add_artifact, analysis_id, "upload", img_path.name,
+                            media_type_for(img_path.name))
+    return analysis_id, img_path, digest
+
 
-    result = run_analysis(image_bytes)
+def _discard_upload(analysis_id: str, img_path: Path):
+    """Delete an upload that will never get a record, and its index entry."""
+    img_path.unlink(missing_ok=True)
+    history_index.remove_artifact(analysis_id, "upload")
+
+
+async def _analyze_upload(analysis_id: str, img_path: Path, digest: str,
+                          inline: bool, render: str, region_format: str, on_stage=None) -> dict:
+    """
+    Analyze a stored upload, queue its record for writing and build the API response.
+    With on_stage (see run_analysis) the call also waits for the record to be
+    stored and reports a final "persisted" stage.
+    """
+    try:
+        result = await run_analysis(img_path, inline_image=inline, render_mode=render, digest=digest,
+                                    on_stage=on_stage)
+    except WorkerPoolFull as e:
+        logger.warning("Rejected: CPU worker pool saturated")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except UpstreamUnavailable as e:
+        logger.warning("Rejected: %s", e)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except InvalidImage as e:
+        logger.warning("Rejected: %s is not a valid image", img_path.name)
+        await asyncio.to_thread(_discard_upload, analysis_id, img_path)
+        raise HTTPException(status_code=400, detail=str(e))
 
     if not result["success"]:
         raise HTTPException(status_code=500, detail=result.get("error", "Analysis failed"))
 
-    record = {
+    annotated_path = UPLOADS_DIR / f"{analysis_id}_annotated{extension_for(result['image_media_type'])}"
+    artifacts = {"upload": img_path.name, "annotated": annotated_path.name}
+    regions = result.get("regions", {})
+    record = build_record(
+        analysis_id,
+        datetime.now().isoformat(),
+        result["metrics"],
+        encode_regions(regions),
+        result.get("image_width"),
+        result.get("image_height"),
+        artifacts,
+    )
+    json_path = UPLOADS_DIR / f"{analysis_id}.json"
+    # Indexed only once both files are on disk; until then they are served
+    # from the writer's pending queue.
+    written = record_writer.submit(
+        [(annotated_path, result["annotated_image"]), (json_path, serialize_record(record))],
+        on_done=lambda: history_index.upsert(record),
+    )
+    logger.info("Queued %s and %s for writing", annotated_path.name, json_path.name)
+    if on_stage is not None:
+        try:
+            await asyncio.wrap_future(written)
+            on_stage("persisted", None)
+        except Exception as e:
+            logger.warning("Could not persist %s: %s", analysis_id, e)
+
+    response = {
         "id": analysis_id,
-        "timestamp": datetime.now().isoformat(),
-        "image_file": img_path.name,
         "metrics": result["metrics"],
-        "image_base64": result["image_base64"],
-        "regions": result.get("regions", {}),
+        "image_url": f"/history/{analysis_id}/annotated",
+        "image_media_type": result["image_media_type"],
+        "regions": encode_regions(regions, region_format),
+        "regions_format": region_format,
         "image_width": result.get("image_width"),
         "image_height": result.get("image_height"),
+        "cached": result.get("cached", False),
     }
-    json_path = UPLOADS_DIR / f"{analysis_id}.json"
+    if inline:
+        response["image_base64"] = result["image_base64"]
+    return response
+
+
+def _job_queue_full(e: JobQueueFull) -> HTTPException:
+    logger.warning("Rejected: analysis job queue full")
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+@app.post("/analyze")
+async def analyze(
+    image: UploadFile = File(..., description="Image file (JPEG/PNG)"),
+    inline: bool = Query(False, description="Also embed the annotated image as base64 (legacy clients)"),
+    render: str = Query("face", pattern="^(face|panel)$", description="'panel' adds the full metrics panel"),
+    region_format: str = Query("objects", alias="regions", pattern=REGION_FORMAT_PATTERN,
+                               description="'packed' or 'columns' for compact integer arrays"),
+    job: bool = Query(False, description="Return a job ID immediately and run the analysis in the background"),
+    stream: bool = Query(False, description="Stream progress as server-sent events (a job whose events are the response)"),
+):
+    """
+    Accept image upload, run skin analysis, return metrics and annotated image URL.
+    With job=true the upload is accepted with 202 and a job ID right away; the
+    /analyze response is then available from /jobs/{id} or /jobs/{id}/events.
+    With stream=true the same job events are the response body, so stages and
+    the metrics arrive while the annotated image is still being produced.
+    """
+    logger.info("=== INCOMING REQUEST ===")
+    if job or stream:
+        # Refuse before storing the upload when the job queue is already full.
+        try:
+            analysis_jobs.check_capacity()
+        except JobQueueFull as e:
+            raise _job_queue_full(e)
+    analysis_id, img_path, digest = await _receive_upload(image)
+    if not (job or stream):
+        return await _analyze_upload(analysis_id, img_path, digest, inline, render, region_format)
+
+    async def run(analysis_job):
+        def on_stage(stage, data):
+            analysis_job.stage(stage)
+            if stage == "upstream_parsed":
+                analysis_job.publish("metrics", data)
+
+        try:
+            analysis_job.finish(await _analyze_upload(
+                analysis_id, img_path, digest, inline, render, region_format, on_stage=on_stage,
+            ))
+        except HTTPException as e:
+            retry_after = (e.headers or {}).get("Retry-After")
+            analysis_job.fail(e.status_code, e.detail, int(retry_after) if retry_after else None)
+        except Exception as e:
+            logger.error("Job %s failed: %s", analysis_id, e)
+            analysis_job.fail(500, str(e))
+
     try:
-        json_path.write_text(json.dumps(record, default=str), encoding="utf-8")
-        logger.info("Saved analysis JSON to %s", json_path)
-    except Exception as e:
-        logger.warning("Could not save analysis JSON: %s", e)
+        analysis_job = analysis_jobs.submit(analysis_id, run)
+    except JobQueueFull as e:
+        await asyncio.to_thread(img_path.unlink, missing_ok=True)
+        raise _job_queue_full(e)
+    analysis_job.stage("received")
+    if stream:
+        return _event_stream_response(analysis_job)
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": analysis_id,
+            "status": "queued",
+            "status_url": f"/jobs/{analysis_id}",
+            "events_url": f"/jobs/{analysis_id}/events",
+        },
+        headers={"Location": f"/jobs/{analysis_id}"},
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Poll a job: its status plus the /analyze response ("result") or "error" once finished."""
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    Server-sent events for a job: "status" and "stage" events, one "metrics"
+    event once the upstream response is parsed, then a final "result" (the
+    /analyze response) or "failed" (the error) event. Event IDs let a
+    reconnecting client resume via Last-Event-ID.
+    """
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        sent = int(request.headers.get("last-event-id", "-1")) + 1
+    except ValueError:
+        sent = 0
+    return _event_stream_response(job, sent)
+
+
+def _event_stream_response(job, sent: int = 0) -> StreamingResponse:
+    """Stream a job's events from index sent onwards as text/event-stream."""
+
+    async def stream():
+        nonlocal sent
+        while True:
+            events = await job.wait_for_events(sent, JOB_HEARTBEAT)
+            if not events and not job.done:
+                yield ": keep-alive\n\n"
+                continue
+            for event, data in events:
+                yield f"id: {sent}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+                sent += 1
+            if job.done and sent >= len(job.events):
+                return
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/analyze/batch")
+async def analyze_batch(
+    images: List[UploadFile] = File(..., description="Image files (JPEG/PNG), e.g. one visit's profiles"),
+    render: str = Query("face", pattern="^(face|panel)$", description="'panel' adds the full metrics panel"),
+    region_format: str = Query("objects", alias="regions", pattern=REGION_FORMAT_PATTERN,
+                               description="'packed' or 'columns' for compact integer arrays"),
+):
+    """
+    Analyze several images in one request. Uploads are stored first, then
+    analyzed concurrently (at most BATCH_CONCURRENCY at a time). Results stream
+    back as NDJSON in completion order: one line per image with its "index"
+    in the request, an HTTP-style "status", and either the /analyze response
+    fields or an error "detail".
+    """
+    logger.info("=== INCOMING BATCH: %d images ===", len(images))
+    if len(images) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_FILES} images per batch")
+
+    received = []
+    for index, image in enumerate(images):
+        try:
+            received.append((index, image.filename, await _receive_upload(image), None))
+        except HTTPException as e:
+            received.append((index, image.filename, None, e))
+
+    in_flight = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def analyze_one(index, filename, stored, error):
+        line = {"index": index, "filename": filename}
+        if error is None:
+            try:
+                async with in_flight:
+                    try:
+                        response = await _analyze_upload(*stored, False, render, region_format)
+                        return {**line, "status": 200, **response}
+                    except HTTPException as e:
+                        error = e
+                    except Exception as e:
+                        logger.error("Batch item %d failed: %s", index, e)
+                        error = HTTPException(status_code=500, detail=str(e))
+            except asyncio.CancelledError:
+                # Client went away before this image was analyzed; nothing will reference its upload.
+                _discard_upload(*stored[:2])
+                raise
+        line.update(status=error.status_code, detail=error.detail)
+        if error.headers and "Retry-After" in error.headers:
+            line["retry_after"] = int(error.headers["Retry-After"])
+        return line
+
+    async def stream():
+        tasks = [asyncio.ensure_future(analyze_one(*item)) for item in received]
+        try:
+            for done in asyncio.as_completed(tasks):
+                yield json.dumps(await done, default=str) + "\n"
+        finally:
+            # Client went away: stop analyses that have not finished.
+            for task in tasks:
+                task.cancel()
 
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/stats")
+async def stats():
+    """Runtime counters for monitoring."""
+    # async: the upstream and job counters belong to the event loop.
     return {
-        "id": analysis_id,
-        "metrics": result["metrics"],
-        "image_base64": result["image_base64"],
-        "regions": result.get("regions", {}),
-        "image_width": result.get("image_width"),
-        "image_height": result.get("image_height"),
+        "cache": response_cache.stats(),
+        "writer": record_writer.stats(),
+        "upstream": upstream_stats(),
+        "jobs": analysis_jobs.stats(),
     }
 
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+def _encode_cursor(analysis_id: str) -> str:
+    return base64.urlsafe_b64encode(analysis_id.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> str:
+    try:
+        analysis_id = base64.b64decode(cursor + "=" * (-len(cursor) % 4), altchars=b"-_", validate=True).decode("utf-8")
+    except Exception:
+        analysis_id = ""
+    if not analysis_id:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return analysis_id
+
+
+def _parse_bound(value: Optional[str], name: str, end: bool = False) -> Optional[str]:
+    """
+    Parse a since/until query value; a date-only until covers that whole day.
+    Stored timestamps are naive local time, so an offset (e.g. "Z") is
+    converted to local time first.
+    """
+    if not value:
+        return None
+    try:
+        if len(value) == 10:
+            day = datetime.strptime(value, "%Y-%m-%d")
+            return (day + timedelta(days=1) if end else day).isoformat()
+        bound = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid '{name}': expected an ISO date or datetime")
+    if bound.tzinfo is not None:
+        bound = bound.astimezone().replace(tzinfo=None)
+    return (bound + timedelta(microseconds=1) if end else bound).isoformat()
+
+
 @app.get("/history")
-def history():
-    """List all past analyses, newest first."""
-    entries = []
-    for jf in sorted(UPLOADS_DIR.glob("*.json"), reverse=True):
-        try:
-            data = json.loads(jf.read_text(encoding="utf-8"))
-            entries.append({
-                "id": data.get("id", jf.stem),
-                "timestamp": data.get("timestamp", ""),
-                "image_file": data.get("image_file", ""),
-            })
-        except Exception:
-            continue
-    return entries
+def history(
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    since: Optional[str] = Query(None, description="Earliest timestamp (ISO date or datetime)"),
+    until: Optional[str] = Query(None, description="Latest timestamp (ISO date or datetime, inclusive)"),
+    skin_type: Optional[str] = None,
+    min_score: Optional[float] = Query(None, description="Minimum total_score"),
+    max_score: Optional[float] = Query(None, description="Maximum total_score"),
+):
+    """List past analyses newest first, one page at a time (served from the history index)."""
+    entries, last_id = history_index.page(
+        limit,
+        before_id=_decode_cursor(cursor) if cursor else None,
+        since=_parse_bound(since, "since"),
+        until=_parse_bound(until, "until", end=True),
+        skin_type=skin_type,
+        min_score=min_score,
+        max_score=max_score,
+    )
+    return {
+        "entries": entries,
+        "next_cursor": _encode_cursor(last_id) if last_id else None,
+    }
 
 
 @app.get("/history/{analysis_id}/thumb")
-def history_thumb(analysis_id: str):
-    """Return the original uploaded image for a given analysis."""
-    for ext in (".jpg", ".jpeg", ".png", ".webp"):
-        path = UPLOADS_DIR / f"{analysis_id}{ext}"
-        if path.exists():
-            media = "image/jpeg" if ext in (".jpg", ".jpeg") else f"image/{ext.lstrip('.')}"
-            return FileResponse(path, media_type=media)
-    raise HTTPException(status_code=404, detail="Image not found")
-
-
-def _extract_regions_from_metrics(metrics: dict) -> dict:
-    """Rebuild region rectangles from the raw API response stored in metrics."""
-    r = metrics.get("result", {})
-    face_rect = metrics.get("face_rectangle", {})
-
-    def rect_to_dict(rect):
-        if not rect or not isinstance(rect, dict):
-            return None
-        return {
-            "left": rect.get("left", 0),
-            "top": rect.get("top", 0),
-            "width": rect.get("width", 0),
-            "height": rect.get("height", 0),
-        }
+def history_thumb(analysis_id: str, request: Request):
+    """Return a small thumbnail of the uploaded image, generated on first request."""
+    thumb = _artifact(analysis_id, "thumb")
+    if thumb:
+        return _artifact_response(request, *thumb)
+    upload = _artifact(analysis_id, "upload")
+    if not upload:
+        raise HTTPException(status_code=404, detail="Image not found")
+    thumb_path = UPLOADS_DIR / f"{analysis_id}_thumb{THUMB_EXT}"
+    try:
+        create_thumbnail(upload[0], thumb_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    except Exception as e:
+        logger.warning("Could not create thumbnail for %s: %s", analysis_id, e)
+        # Not cacheable: the URL must show a real thumbnail once one can be built.
+        return _artifact_response(request, *upload, immutable=False)
+    history_index.add_artifact(analysis_id, "thumb", thumb_path.name, THUMB_MEDIA_TYPE)
+    return _artifact_response(request, thumb_path, THUMB_MEDIA_TYPE)
 
-    regions = {}
-    if face_rect:
-        regions["face"] = [rect_to_dict(face_rect)]
-    dcm = r.get("dark_circle_mark", {})
-    dark_rects = []
-    for key in ("left_eye_rect", "right_eye_rect"):
-        dr = rect_to_dict(dcm.get(key))
-        if dr:
-            dark_rects.append(dr)
-    if dark_rects:
-        regions["dark_circle"] = dark_rects
-
-    eye_pouch_rects = []
-    for key in ("left_eye_pouch_rect", "right_eye_pouch_rect"):
-        ep = rect_to_dict(r.get(key))
-        if ep:
-            eye_pouch_rects.append(ep)
-    if eye_pouch_rects:
-        regions["eye_pouch"] = eye_pouch_rects
-
-    for key, region_key in [
-        ("brown_spot", "brown_spot"),
-        ("closed_comedones", "blackhead"),
-        ("acne_mark", "acne_mark"),
-        ("acne", "acne"),
-        ("mole", "mole"),
-        ("acne_nodule", "acne_nodule"),
-        ("acne_pustule", "acne_pustule"),
-    ]:
-        rects = [rect_to_dict(x) for x in r.get(key, {}).get("rectangle", [])]
-        rects = [x for x in rects if x]
-        if rects:
-            regions[region_key] = rects
-    return regions
-
-
-def _extract_image_dimensions(metrics: dict) -> tuple:
-    """Get image dimensions from face_rectangle as a rough estimate."""
-    fr = metrics.get("face_rectangle", {})
-    if fr:
-        w = fr.get("left", 0) + fr.get("width", 0) + fr.get("left", 0)
-        h = fr.get("top", 0) + fr.get("height", 0) + fr.get("top", 0)
-        return w, h
-    return 0, 0
+
+@app.get("/history/{analysis_id}/image")
+def history_image(analysis_id: str, request: Request):
+    """Return the original uploaded image for a given analysis."""
+    upload = _artifact(analysis_id, "upload")
+    if not upload:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return _artifact_response(request, *upload)
+
+
+@app.get("/history/{analysis_id}/annotated")
+def history_annotated(analysis_id: str, request: Request):
+    """Return the annotated analysis image for a given analysis."""
+    annotated = _artifact(analysis_id, "annotated")
+    if annotated:
+        return _artifact_response(request, *annotated)
+
+    # Just analyzed: the record is still queued and not indexed yet.
+    if record_writer.pending(UPLOADS_DIR / f"{analysis_id}.json") is not None:
+        stored = _read_record(analysis_id)["artifacts"]["annotated"]
+        return _artifact_response(request, UPLOADS_DIR / stored["file"], stored["media_type"])
+
+    # Older records embedded the annotated image as a base64 data URL, or were
+    # migrated by migrate_records.py after the index was warmed.
+    if history_index.is_indexed(analysis_id):
+        data = _read_record(analysis_id)
+        stored = (data.get("artifacts") or {}).get("annotated")
+        if stored:
+            history_index.add_artifact(analysis_id, "annotated", stored["file"], stored["media_type"])
+            return _artifact_response(request, UPLOADS_DIR / stored["file"], stored["media_type"])
+        data_url = data.get("image_base64") or ""
+        if data_url.startswith("data:") and "," in data_url:
+            header, encoded = data_url.split(",", 1)
+            media = header[len("data:"):].split(";")[0] or "image/png"
+            return Response(
+                content=base64.b64decode(encoded),
+                media_type=media,
+                headers={"Cache-Control": ARTIFACT_CACHE_CONTROL},
+            )
+    raise HTTPException(status_code=404, detail="Annotated image not found")
 
 
 @app.get("/history/{analysis_id}/data")
-def history_data(analysis_id: str):
+def history_data(
+    analysis_id: str,
+    region_format: str = Query("objects", alias="regions", pattern=REGION_FORMAT_PATTERN,
+                               description="'packed' or 'columns' for compact integer arrays"),
+):
     """Return stored analysis data with regions (backfills from metrics if needed)."""
-    json_path = UPLOADS_DIR / f"{analysis_id}.json"
-    if not json_path.exists():
+    try:
+        data = _read_record(analysis_id)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Analysis not found")
-    data = json.loads(json_path.read_text(encoding="utf-8"))
+    # Records not yet rewritten by migrate_records.py may still embed the image.
     data.pop("image_base64", None)
+    data.setdefault("id", analysis_id)
+    upload = _artifact(analysis_id, "upload")
+    backfill_record(data, UPLOADS_DIR, upload[0] if upload else None)
+    if region_format != "objects":
+        data["regions"] = encode_regions(regions_from_dicts(data.get("regions") or {}), region_format)
+    data["regions_format"] = region_format
+    return data
 
-    if "regions" not in data and "metrics" in data:
-        data["regions"] = _extract_regions_from_metrics(data["metrics"])
-
-    if "image_width" not in data and "metrics" in data:
-        img_path = None
-        for ext in (".jpg", ".jpeg", ".png", ".webp"):
-            p = UPLOADS_DIR / f"{analysis_id}{ext}"
-            if p.exists():
-                img_path = p
-                break
-        if img_path:
-            try:
-                from PIL import Image
-                img = Image.open(img_path)
-                data["image_width"], data["image_height"] = img.size
-            except Exception:
-                w, h = _extract_image_dimensions(data["metrics"])
-                data["image_width"] = w
-                data["image_height"] = h
-        else:
-            w, h = _extract_image_dimensions(data["metrics"])
-            data["image_width"] = w
-            data["image_height"] = h
 
-    return data
+def _direction(key: str) -> str:
+    if key in HIGHER_IS_BETTER:
+        return "higher_is_better"
+    if key in LOWER_IS_BETTER:
+        return "lower_is_better"
+    return "neutral"
+
+
+def _load_compare_row(analysis_id: str) -> tuple:
+    """Return (timestamp, compare row) from the index, falling back to the JSON record."""
+    hit = history_index.compare_row(analysis_id)
+    if hit is not None:
+        return hit
+    try:
+        data = _read_record(analysis_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Analysis '{analysis_id}' not found")
+    return data.get("timestamp", ""), extract_row(data.get("metrics", {}))
 
 
 @app.get("/compare/{before_id}/{after_id}")
 def compare(before_id: str, after_id: str):
     """Compare two analyses, returning meaningful parameter differences."""
-    before_path = UPLOADS_DIR / f"{before_id}.json"
-    after_path = UPLOADS_DIR / f"{after_id}.json"
-
-    if not before_path.exists():
-        raise HTTPException(status_code=404, detail=f"Analysis '{before_id}' not found")
-    if not after_path.exists():
-        raise HTTPException(status_code=404, detail=f"Analysis '{after_id}' not found")
-
-    before_data = json.loads(before_path.read_text(encoding="utf-8"))
-    after_data = json.loads(after_path.read_text(encoding="utf-8"))
-    before_metrics = before_data.get("metrics", {})
-    after_metrics = after_data.get("metrics", {})
+    before_ts, before_row = _load_compare_row(before_id)
+    after_ts, after_row = _load_compare_row(after_id)
 
     comparisons = []
-    for key in COMPARE_KEYS:
-        bv = _get_nested(before_metrics, key)
-        av = _get_nested(after_metrics, key)
+    for key, bv, av in zip(COMPARE_KEYS, before_row, after_row):
         if bv is None and av is None:
             continue
         label = COMPARE_LABELS.get(key, key)
@@ -462,12 +738,6 @@ def compare(before_id: str, after_id: str):
 
         verdict = _judge_change(key, bv, av)
         is_numeric = isinstance(bv, (int, float)) or isinstance(av, (int, float))
-        if key in HIGHER_IS_BETTER:
-            direction = "higher_is_better"
-        elif key in LOWER_IS_BETTER:
-            direction = "lower_is_better"
-        else:
-            direction = "neutral"
         comparisons.append({
             "key": key,
             "label": label,
@@ -476,16 +746,75 @@ def compare(before_id: str, after_id: str):
             "verdict": verdict,
             "category": COMPARE_CATEGORIES.get(key, "Other"),
             "numeric": is_numeric,
-            "direction": direction,
+            "direction": _direction(key),
         })
 
     return {
-        "before": {"id": before_id, "timestamp": before_data.get("timestamp", "")},
-        "after": {"id": after_id, "timestamp": after_data.get("timestamp", "")},
+        "before": {"id": before_id, "timestamp": before_ts},
+        "after": {"id": after_id, "timestamp": after_ts},
         "comparisons": comparisons,
     }
 
 
+TIMELINE_MAX_POINTS = 500
+
+
+@app.get("/timeline")
+def timeline(
+    ids: Optional[str] = Query(None, description="Comma-separated analysis IDs"),
+    since: Optional[str] = Query(None, description="Earliest timestamp (ISO date or datetime)"),
+    until: Optional[str] = Query(None, description="Latest timestamp (ISO date or datetime, inclusive)"),
+    limit: int = Query(TIMELINE_MAX_POINTS, ge=1, le=TIMELINE_MAX_POINTS),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous response"),
+):
+    """
+    Metric trends across many analyses in one columnar response, oldest first.
+    Select analyses by ID list or by date range; series[key]["values"][i]
+    belongs to ids[i]. A range with more than limit analyses is truncated:
+    pass next_cursor back as cursor for the following points.
+    """
+    id_list = None
+    if ids:
+        id_list = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+        if len(id_list) > limit:
+            raise HTTPException(status_code=400, detail=f"At most {limit} IDs per request")
+    elif not since and not until:
+        raise HTTPException(status_code=400, detail="Provide 'ids' or a 'since'/'until' range")
+
+    rows, last_id = history_index.compare_rows(
+        ids=id_list,
+        since=_parse_bound(since, "since"),
+        until=_parse_bound(until, "until", end=True),
+        # An ID list never exceeds limit, so only ranges are paged.
+        after_id=_decode_cursor(cursor) if cursor and id_list is None else None,
+        limit=limit,
+    )
+    if id_list is not None:
+        missing = set(id_list) - {r[0] for r in rows}
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Analyses not found: {', '.join(sorted(missing))}")
+
+    series = {}
+    for i, key in enumerate(COMPARE_KEYS):
+        values = [row[i] for _, _, row in rows]
+        if all(v is None for v in values):
+            continue
+        series[key] = {
+            "label": COMPARE_LABELS.get(key, key),
+            "category": COMPARE_CATEGORIES.get(key, "Other"),
+            "direction": _direction(key),
+            "values": [round(v, 2) if isinstance(v, float) else v for v in values],
+        }
+
+    return {
+        "ids": [r[0] for r in rows],
+        "timestamps": [r[1] for r in rows],
+        "series": series,
+        "truncated": last_id is not None,
+        "next_cursor": _encode_cursor(last_id) if last_id else None,
+    }
+
+
 FRONTEND_DIR = Path(__file__).resolve().parent.parent / "Web_app"
 if FRONTEND_DIR.is_dir():
     app.mount("/", StaticFiles(directory=str(FRONTEND_DIR), html=True), name="frontend")
@@ -0,0 +1,57 @@
+"""
+Rewrite stored analysis records in place to the current record format.
+Embedded image_base64 blobs are moved to separate image files and artifact
+paths are recorded. Safe to run repeatedly; current records are skipped.
+
+Usage: python migrate_records.py [--uploads DIR] [--dry-run]
+"""
+import sys
+import json
+import argparse
+from pathlib import Path
+
+from records import RECORD_VERSION, migrate_record, write_record
+
+DEFAULT_UPLOADS_DIR = Path(__file__).resolve().parent / "uploads"
+
+
+def migrate_all(uploads_dir: Path, dry_run: bool = False) -> dict:
+    counts = {"migrated": 0, "current": 0, "failed": 0}
+    for jf in sorted(uploads_dir.glob("*.json")):
+        try:
+            data = json.loads(jf.read_text(encoding="utf-8"))
+            data.setdefault("id", jf.stem)
+            if dry_run:
+                changed = data.get("version") != RECORD_VERSION
+            else:
+                changed = migrate_record(data, uploads_dir)
+                if changed:
+                    write_record(jf, data)
+        except Exception as e:
+            print(f"  failed: {jf.name}: {e}", file=sys.stderr)
+            counts["failed"] += 1
+            continue
+        if changed:
+            print(f"  {'would migrate' if dry_run else 'migrated'}: {jf.name}")
+            counts["migrated"] += 1
+        else:
+            counts["current"] += 1
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--uploads", type=Path, default=DEFAULT_UPLOADS_DIR, help="uploads directory")
+    parser.add_argument("--dry-run", action="store_true", help="list records that need migrating")
+    args = parser.parse_args(argv)
+
+    if not args.uploads.is_dir():
+        print(f"Uploads directory not found: {args.uploads}", file=sys.stderr)
+        return 1
+    counts = migrate_all(args.uploads, dry_run=args.dry_run)
+    print(f"{counts['migrated']} migrated, {counts['current']} already current, {counts['failed']} failed")
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
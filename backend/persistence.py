@@ -0,0 +1,156 @@
+"""
+Background writer for analysis artifacts and records.
+Requests hand over finished bytes and return immediately; a single writer
+thread stores them atomically (temp file + fsync + rename) in batches, with
+one directory fsync per batch. Until a file is on disk its bytes stay
+readable through pending().
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """
+    Write jobs are lists of (path, bytes) stored together, plus an optional
+    on_done callback run on the writer thread once every file is durable.
+    Jobs arriving within batch_window seconds of each other share one flush.
+    """
+
+    def __init__(self, batch_window: float = 0.02, max_batch: int = 64):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._pending = {}  # path -> bytes not yet on disk
+        self._lock = threading.Lock()
+        self._thread = None
+        self._counters = {"jobs": 0, "files": 0, "batches": 0, "failed": 0}
+
+    def submit(self, files, on_done=None) -> Future:
+        """
+        Queue files ([(path, bytes), ...]) for writing; never blocks on disk.
+        The returned future resolves once they are durable (after on_done) or
+        carries the write error.
+        """
+        files = [(Path(path), data) for path, data in files]
+        done = Future()
+        with self._lock:
+            for path, data in files:
+                self._pending[path] = data
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="record-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((files, on_done, done))
+        return done
+
+    def pending(self, path: Path):
+        """Bytes queued for path that are not on disk yet, or None."""
+        with self._lock:
+            return self._pending.get(Path(path))
+
+    def close(self):
+        """Flush everything queued and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._counters, "queued": self._queue.qsize(), "pending_files": len(self._pending)}
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            batch = [job]
+            deadline = time.monotonic() + self.batch_window
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stop = True
+                    break
+                batch.append(job)
+            self._flush(batch)
+            if stop:
+                return
+
+    def _flush(self, batch):
+        """Write a batch: temp files, fsync each, rename, then fsync each directory once."""
+        written, failed = [], []
+        for files, on_done, done in batch:
+            temps = []
+            try:
+                for path, data in files:
+                    tmp = path.with_name(f"{path.name}.tmp")
+                    with open(tmp, "wb") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    temps.append((tmp, path))
+                for tmp, path in temps:
+                    os.replace(tmp, path)
+                written.append((files, on_done, done))
+            except Exception as e:
+                logger.warning("Could not persist %s: %s", ", ".join(p.name for p, _ in files), e)
+                for tmp, _ in temps:
+                    try:
+                        tmp.unlink(missing_ok=True)
+                    except OSError:
+                        pass
+                failed.append((done, e))
+
+        for directory in {path.parent for files, _, _ in written for path, _ in files}:
+            _fsync_dir(directory)
+
+        # Callbacks (e.g. indexing) run before pending bytes are dropped, so a
+        # reader always finds the data in one place or the other.
+        for _, on_done, _ in written:
+            if on_done is not None:
+                try:
+                    on_done()
+                except Exception as e:
+                    logger.warning("Post-write callback failed: %s", e)
+
+        with self._lock:
+            for files, _, _ in batch:
+                for path, data in files:
+                    if self._pending.get(path) is data:
+                        del self._pending[path]
+            self._counters["jobs"] += len(written)
+            self._counters["files"] += sum(len(files) for files, _, _ in written)
+            self._counters["batches"] += 1
+            self._counters["failed"] += len(failed)
+
+        for _, _, done in written:
+            done.set_result(None)
+        for done, e in failed:
+            done.set_exception(e)
+
+
+def _fsync_dir(directory: Path):
+    """Make renames in directory durable (no-op where directories can't be opened)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
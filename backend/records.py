@@ -0,0 +1,163 @@
+"""
+Persisted analysis records.
+Each analysis is a small JSON document ({id}.json) holding metrics, regions and
+image size. Image artifacts (the upload and the annotated image) are separate
+binary files next to it, listed in the record's "artifacts" map.
+"""
+import os
+import json
+import time
+import base64
+import secrets
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from regions import extract_regions, encode_regions
+
+RECORD_VERSION = 2
+UPLOAD_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+_id_lock = threading.Lock()
+_last_id_us = 0
+
+
+def new_analysis_id() -> str:
+    """
+    Unique, time-sortable analysis ID: YYYYMMDD_HHMMSS_ffffff_<8 hex>.
+    Microseconds never repeat within a process (a clash is bumped forward) and
+    the random suffix separates concurrent workers. The legacy YYYYMMDD_HHMMSS
+    IDs are a prefix of this layout, so old and new IDs sort together.
+    """
+    global _last_id_us
+    with _id_lock:
+        now_us = max(time.time_ns() // 1000, _last_id_us + 1)
+        _last_id_us = now_us
+    stamp = datetime.fromtimestamp(now_us // 1_000_000).strftime("%Y%m%d_%H%M%S")
+    return f"{stamp}_{now_us % 1_000_000:06d}_{secrets.token_hex(4)}"
+
+
+def media_type_for(filename: str) -> str:
+    """Media type for a stored image file, based on its extension."""
+    ext = Path(filename).suffix.lower()
+    if ext in (".jpg", ".jpeg"):
+        return "image/jpeg"
+    return f"image/{ext.lstrip('.') or 'png'}"
+
+
+def extension_for(media_type: str) -> str:
+    """File extension for an image media type."""
+    if media_type == "image/jpeg":
+        return ".jpg"
+    return "." + media_type.split("/")[-1]
+
+
+def artifact(filename: str) -> dict:
+    return {"file": filename, "media_type": media_type_for(filename)}
+
+
+def build_record(analysis_id: str, timestamp: str, metrics: dict, regions: dict,
+                 width, height, artifacts: dict) -> dict:
+    """Assemble a current-version record. artifacts maps kind -> filename."""
+    return {
+        "version": RECORD_VERSION,
+        "id": analysis_id,
+        "timestamp": timestamp,
+        "image_file": artifacts.get("upload", ""),
+        "metrics": metrics,
+        "regions": regions,
+        "image_width": width,
+        "image_height": height,
+        "artifacts": {kind: artifact(name) for kind, name in artifacts.items() if name},
+    }
+
+
+def serialize_record(record: dict) -> bytes:
+    return json.dumps(record, default=str).encode("utf-8")
+
+
+def write_record(path: Path, record: dict):
+    """Write a record atomically (temp file + rename)."""
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_bytes(serialize_record(record))
+    os.replace(tmp, path)
+
+
+def find_upload(uploads_dir: Path, analysis_id: str):
+    """Locate the original upload for an analysis by probing known extensions."""
+    for ext in UPLOAD_EXTENSIONS:
+        p = uploads_dir / f"{analysis_id}{ext}"
+        if p.exists():
+            return p
+    return None
+
+
+def extract_image_dimensions(metrics: dict) -> tuple:
+    """Get image dimensions from face_rectangle as a rough estimate."""
+    fr = metrics.get("face_rectangle", {})
+    if fr:
+        w = fr.get("left", 0) + fr.get("width", 0) + fr.get("left", 0)
+        h = fr.get("top", 0) + fr.get("height", 0) + fr.get("top", 0)
+        return w, h
+    return 0, 0
+
+
+def backfill_record(data: dict, uploads_dir: Path, upload_path: Path = None) -> bool:
+    """
+    Fill in regions and image size missing from older records. Returns True if changed.
+    upload_path skips probing uploads_dir when the upload location is already known.
+    """
+    changed = False
+    if "regions" not in data and "metrics" in data:
+        data["regions"] = encode_regions(extract_regions(data["metrics"]))
+        changed = True
+
+    if "image_width" not in data and "metrics" in data:
+        img_path = upload_path or find_upload(uploads_dir, data.get("id", ""))
+        if img_path:
+            try:
+                from PIL import Image
+                with Image.open(img_path) as img:
+                    data["image_width"], data["image_height"] = img.size
+            except Exception:
+                data["image_width"], data["image_height"] = extract_image_dimensions(data["metrics"])
+        else:
+            data["image_width"], data["image_height"] = extract_image_dimensions(data["metrics"])
+        changed = True
+    return changed
+
+
+def migrate_record(data: dict, uploads_dir: Path) -> bool:
+    """
+    Upgrade a record to RECORD_VERSION in place: move an embedded image_base64
+    blob into its own file and record artifact paths. Returns True if changed.
+    """
+    if data.get("version") == RECORD_VERSION:
+        return False
+    analysis_id = data.get("id", "")
+    artifacts = dict(data.get("artifacts") or {})
+
+    upload = data.get("image_file") or ""
+    if not upload:
+        found = find_upload(uploads_dir, analysis_id)
+        upload = found.name if found else ""
+    if upload and "upload" not in artifacts:
+        artifacts["upload"] = artifact(upload)
+
+    data_url = data.pop("image_base64", None) or ""
+    if data_url.startswith("data:") and "," in data_url and "annotated" not in artifacts:
+        header, encoded = data_url.split(",", 1)
+        media = header[len("data:"):].split(";")[0] or "image/png"
+        annotated = uploads_dir / f"{analysis_id}_annotated{extension_for(media)}"
+        annotated.write_bytes(base64.b64decode(encoded))
+        artifacts["annotated"] = {"file": annotated.name, "media_type": media}
+    annotated_file = data.pop("annotated_file", None)
+    if annotated_file and "annotated" not in artifacts:
+        artifacts["annotated"] = artifact(annotated_file)
+
+    backfill_record(data, uploads_dir)
+    data["image_file"] = upload
+    data["artifacts"] = artifacts
+    data["version"] = RECORD_VERSION
+    return True
@@ -0,0 +1,91 @@
+"""
+Region rectangles for interactive highlighting.
+One extractor turns a raw API response into {region_key: [Rect, ...]}; the
+encoders below serialize that as objects (default), packed or column arrays.
+"""
+
+# (API result key, region key) for the lesion lists under result.<key>.rectangle
+LESION_REGIONS = [
+    ("brown_spot", "brown_spot"),
+    ("closed_comedones", "blackhead"),
+    ("acne_mark", "acne_mark"),
+    ("acne", "acne"),
+    ("mole", "mole"),
+    ("acne_nodule", "acne_nodule"),
+    ("acne_pustule", "acne_pustule"),
+]
+
+REGION_FORMATS = ("objects", "packed", "columns")
+
+
+class Rect:
+    __slots__ = ("left", "top", "width", "height")
+
+    def __init__(self, left, top, width, height):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_api(cls, rect):
+        """Build a Rect from an API {left, top, width, height} dict, or None if empty."""
+        if not rect or not isinstance(rect, dict):
+            return None
+        return cls(rect.get("left", 0), rect.get("top", 0), rect.get("width", 0), rect.get("height", 0))
+
+    def to_dict(self) -> dict:
+        return {"left": self.left, "top": self.top, "width": self.width, "height": self.height}
+
+
+def extract_regions(metrics: dict) -> dict:
+    """Region key -> list of Rect, from a raw API response."""
+    r = metrics.get("result", {})
+    face_rect = metrics.get("face_rectangle", {})
+    from_api = Rect.from_api
+
+    regions = {}
+    if face_rect:
+        regions["face"] = [from_api(face_rect)]
+
+    dcm = r.get("dark_circle_mark", {})
+    dark_rects = [x for x in (from_api(dcm.get("left_eye_rect")), from_api(dcm.get("right_eye_rect"))) if x]
+    if dark_rects:
+        regions["dark_circle"] = dark_rects
+
+    eye_pouch_rects = [x for x in (from_api(r.get("left_eye_pouch_rect")), from_api(r.get("right_eye_pouch_rect"))) if x]
+    if eye_pouch_rects:
+        regions["eye_pouch"] = eye_pouch_rects
+
+    for key, region_key in LESION_REGIONS:
+        rects = [x for x in map(from_api, r.get(key, {}).get("rectangle", [])) if x]
+        if rects:
+            regions[region_key] = rects
+    return regions
+
+
+def regions_from_dicts(stored: dict) -> dict:
+    """Rebuild Rect lists from the object form kept in stored records."""
+    return {key: [x for x in map(Rect.from_api, rects) if x] for key, rects in stored.items()}
+
+
+def encode_regions(regions: dict, fmt: str = "objects") -> dict:
+    """
+    Serialize {key: [Rect]} as:
+      objects - {key: [{left, top, width, height}, ...]}
+      packed  - {key: [left, top, width, height, left, top, ...]}
+      columns - {key: {"left": [...], "top": [...], "width": [...], "height": [...]}}
+    """
+    if fmt == "objects":
+        return {key: [rect.to_dict() for rect in rects] for key, rects in regions.items()}
+    if fmt == "packed":
+        return {
+            key: [int(v) for rect in rects for v in (rect.left, rect.top, rect.width, rect.height)]
+            for key, rects in regions.items()
+        }
+    if fmt == "columns":
+        return {
+            key: {field: [int(getattr(rect, field)) for rect in rects] for field in Rect.__slots__}
+            for key, rects in regions.items()
+        }
+    raise ValueError(f"Unknown region format: {fmt}")
@@ -0,0 +1,128 @@
+"""
+Rate limiting and failure isolation for the AILab upstream.
+TokenBucket paces calls to the plan's QPS; CircuitBreaker stops calling an
+upstream that keeps failing and lets one probe through after a cool-down.
+Both are used from the event loop only.
+"""
+import time
+import asyncio
+import random
+
+
+class TokenBucket:
+    """
+    Allows rate calls per second on average with bursts of up to burst calls.
+    Tokens are reserved ahead of time, so concurrent callers are spaced out in
+    arrival order rather than retrying in a thundering herd. rate <= 0 disables.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._counters = {"granted": 0, "delayed": 0, "rejected": 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, max_wait: float) -> bool:
+        """Wait for a token. Returns False, without waiting, if that would take over max_wait seconds."""
+        if self.rate <= 0:
+            self._counters["granted"] += 1
+            return True
+        self._refill()
+        wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+        if wait > max_wait:
+            self._counters["rejected"] += 1
+            return False
+        self._tokens -= 1
+        self._counters["granted"] += 1
+        if wait:
+            self._counters["delayed"] += 1
+            await asyncio.sleep(wait)
+        return True
+
+    def stats(self) -> dict:
+        if self.rate > 0:
+            self._refill()
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": round(self._tokens, 3),
+            **self._counters,
+        }
+
+
+class CircuitBreaker:
+    """
+    closed: calls pass; failure_threshold consecutive failures open the breaker.
+    open: calls are refused until reset_timeout seconds have passed.
+    half_open: a single probe call is let through; success closes the breaker,
+    failure reopens it. failure_threshold <= 0 disables.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._counters = {"opened": 0, "rejected": 0}
+
+    def allow(self) -> bool:
+        """Whether a call may go out now."""
+        if self.failure_threshold <= 0:
+            return True
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self._opened_at < self.reset_timeout:
+                self._counters["rejected"] += 1
+                return False
+            self.state = "half_open"
+            self._probe_started = None
+        if self.state == "half_open":
+            # A probe abandoned mid-flight (e.g. cancelled) frees the slot after reset_timeout.
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                self._counters["rejected"] += 1
+                return False
+            self._probe_started = now
+        return True
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker will next let a call through."""
+        if self.state == "closed":
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        self.state = "closed"
+        self._failures = 0
+        self._probe_started = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self.failure_threshold <= 0:
+            return
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            if self.state != "open":
+                self._counters["opened"] += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "retry_after": round(self.retry_after(), 1),
+            **self._counters,
+        }
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff for retry number attempt (0-based)."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
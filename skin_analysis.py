@@ -142,8 +142,9 @@ else:
         y1 = rect_dict.get("top", 0)
         x2 = x1 + rect_dict.get("width", 0)
         y2 = y1 + rect_dict.get("height", 0)
-        for i in range(width):
-            draw.rectangle([x1 - i, y1 - i, x2 + i, y2 + i], outline=color)
+        # One call with an outward-grown box == width stacked 1 px outlines.
+        grow = width - 1
+        draw.rectangle([x1 - grow, y1 - grow, x2 + grow, y2 + grow], outline=color, width=width)
         if label:
             draw.text((x1, y1 - 22), label, fill=color, font=font_sm)
 